@@ -59,7 +59,20 @@ import sys
 import zlib
 import struct
 import math
+import mmap
+import os
+import random
+import time
+import tempfile
+import itertools
 from array import array
+from binascii import hexlify, unhexlify
+from operator import add, mul
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 _adam7 = ((0, 0, 8, 8),
@@ -70,6 +83,32 @@ _adam7 = ((0, 0, 8, 8),
           (1, 0, 2, 2),
           (0, 1, 1, 2))
 
+# Filter types, see http://www.w3.org/TR/PNG/#9Filter-types
+_filter_names = ('none', 'sub', 'up', 'average', 'paeth')
+_filter_bytes = [chr(filter_type) for filter_type in range(5)]
+
+# Compression strategies of zlib, in the order of their values.
+_strategy_names = ('default', 'filtered', 'huffman', 'rle', 'fixed')
+
+# Magnitude of a filtered byte when read as a signed value, for the
+# minimum sum of absolute differences heuristic.
+_signed_abs = ''.join([chr(min(i, 256 - i)) for i in range(256)])
+
+
+def _as_array(data):
+    """
+    Return data as an array of bytes. Strings and buffers are copied
+    with fromstring, because the array constructor treats a buffer as
+    a sequence of characters.
+    """
+    if isinstance(data, array):
+        return data
+    if isinstance(data, (str, buffer)):
+        result = array('B')
+        result.fromstring(data)
+        return result
+    return array('B', data)
+
 
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
@@ -79,6 +118,8 @@ def interleave_planes(ipixels, apixels, ipsize, apsize):
     from each pixel in ipixels followed by the apsize bytes of data
     from each pixel in apixels, for an image of size width x height.
     """
+    ipixels = _as_array(ipixels)
+    apixels = _as_array(apixels)
     itotal = len(ipixels)
     atotal = len(apixels)
     newtotal = itotal + atotal
@@ -96,10 +137,549 @@ def interleave_planes(ipixels, apixels, ipsize, apsize):
     return out
 
 
+# The filters work on whole scanlines packed into one long integer,
+# so that the arithmetic for all bytes in a row runs in C. The masks
+# keep the bytes from borrowing from or carrying into each other.
+
+_byte_masks = {}
+
+
+def _row_to_long(row):
+    """
+    Pack an array of bytes into a long integer, first byte highest.
+    """
+    return long(hexlify(row), 16)
+
+
+def _long_to_row(value, length):
+    """
+    Unpack a long integer into an array of length bytes.
+    """
+    return array('B', unhexlify('%0*x' % (2 * length, value)))
+
+
+def _masks(length):
+    """
+    Return masks with 0x80, 0x7f and 0xfe in each of length bytes.
+    """
+    if length not in _byte_masks:
+        _byte_masks[length] = (long('80' * length, 16),
+                               long('7f' * length, 16),
+                               long('fe' * length, 16))
+    return _byte_masks[length]
+
+
+def _bytewise_sub(x, y, length):
+    """
+    Subtract packed rows byte by byte, modulo 256.
+    """
+    high, low, _ = _masks(length)
+    return ((x | high) - (y & low)) ^ ((x ^ ~y) & high)
+
+
+def _bytewise_add(x, y, length):
+    """
+    Add packed rows byte by byte, modulo 256.
+    """
+    high, low, _ = _masks(length)
+    return ((x & low) + (y & low)) ^ ((x ^ y) & high)
+
+
+def _bytewise_average(x, y, length):
+    """
+    Average packed rows byte by byte, rounding down.
+    """
+    _, _, upper = _masks(length)
+    return (x & y) + (((x ^ y) & upper) >> 1)
+
+
+def _spread(row):
+    """
+    Pack an array of bytes into a long integer with a 16-bit lane for
+    each byte, first byte highest.
+    """
+    lanes = array('B', [0]) * (2 * len(row))
+    lanes[1::2] = row
+    return _row_to_long(lanes)
+
+
+def _bytewise_paeth(line, prev, psize):
+    """
+    Apply the Paeth filter to the array line with the unfiltered
+    previous scanline prev, and return the filtered array.
+    """
+    # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+    # The predictor compares signed differences, so each byte gets a
+    # 16-bit lane, and the differences are offset to stay positive.
+    length = len(line)
+    ones = long('0001' * length, 16)
+    full = ones * 0xffff
+    x = _spread(line)
+    b = _spread(prev)
+    a = x >> (16 * psize)
+    c = b >> (16 * psize)
+
+    def absolute(value, bits):
+        # Each lane of value holds a difference plus 2**bits.
+        offset = ones << bits
+        mask = ((value >> bits) & ones) * 0xffff
+        return ((value & mask) | ((2 * offset - value) & (full ^ mask))
+                ) - offset
+
+    def less_equal(p, q):
+        return ((q + 1024 * ones - p) >> 10) & ones
+
+    pa = absolute(b + 256 * ones - c, 8)
+    pb = absolute(a + 256 * ones - c, 8)
+    pc = absolute(a + b + 512 * ones - c - c, 9)
+    use_a = less_equal(pa, pb) & less_equal(pa, pc)
+    use_b = (use_a ^ ones) & less_equal(pb, pc)
+    use_c = ones ^ use_a ^ use_b
+    predictor = ((a & use_a * 0xffff) | (b & use_b * 0xffff) |
+                 (c & use_c * 0xffff))
+    filtered = (x + 256 * ones - predictor) & (ones * 0xff)
+    return _long_to_row(filtered, 2 * length)[1::2]
+
+
+def _signed_abs_sum(row):
+    """
+    Sum of the filtered bytes in row, read as signed values.
+    """
+    return sum(bytearray(row.tostring().translate(_signed_abs)))
+
+
+# Reversing a filter takes the filter type, the filtered scanline and
+# the unfiltered previous scanline of the same pass (None for the
+# first one) as arrays, and the number of bytes per pixel. It returns
+# the unfiltered scanline, which may be the input array itself.
+
+def _unfilter_python(filter_type, line, prev, psize):
+    """
+    Reverse a scanline filter in pure Python.
+    """
+    # http://www.w3.org/TR/PNG/#9Filter-types
+    length = len(line)
+    if filter_type == 0 or (filter_type == 2 and prev is None):
+        return line
+    if filter_type == 2:
+        return _long_to_row(
+            _bytewise_add(_row_to_long(line), _row_to_long(prev), length),
+            length)
+    if filter_type == 1 or (filter_type == 4 and prev is None):
+        # Each byte is the sum of all bytes to its left that belong to
+        # the same sample, which takes log2(width) shifted additions.
+        x = _row_to_long(line)
+        shift = 8 * psize
+        while shift < 8 * length:
+            x = _bytewise_add(x, x >> shift, length)
+            shift *= 2
+        return _long_to_row(x, length)
+    if filter_type not in (3, 4):
+        raise Error("unknown filter type %s" % filter_type)
+    # Average and Paeth depend on the reconstructed byte to the left,
+    # so each sample of a pixel is run through in order.
+    if prev is None:
+        prev = array('B', [0]) * length
+    out = array('B', line)
+    for i in range(psize):
+        column = array('B')
+        append = column.append
+        a = c = 0
+        if filter_type == 3:
+            for x, b in zip(line[i::psize], prev[i::psize]):
+                a = (x + ((a + b) >> 1)) & 0xff
+                append(a)
+        else:
+            for x, b in zip(line[i::psize], prev[i::psize]):
+                pa = abs(b - c)
+                pb = abs(a - c)
+                pc = abs(a + b - c - c)
+                if pa <= pb and pa <= pc:
+                    a = (x + a) & 0xff
+                elif pb <= pc:
+                    a = (x + b) & 0xff
+                else:
+                    a = (x + c) & 0xff
+                append(a)
+                c = b
+        out[i::psize] = column
+    return out
+
+
+def _unfilter_numpy(filter_type, line, prev, psize):
+    """
+    Reverse a scanline filter with NumPy where it can work on the
+    whole row, and in pure Python otherwise.
+
+    Only sub and up are vectorized. Reversing average and Paeth needs
+    the reconstructed byte to the left, so those filters run through
+    the Python loops of _unfilter_python() with either backend.
+    """
+    if filter_type == 1 or (filter_type == 4 and prev is None):
+        pixels = numpy.frombuffer(line, numpy.uint8).reshape(-1, psize)
+        return array('B',
+            numpy.cumsum(pixels, axis=0, dtype=numpy.uint8).tostring())
+    if filter_type == 2 and prev is not None:
+        return array('B', (numpy.frombuffer(line, numpy.uint8) +
+                           numpy.frombuffer(prev, numpy.uint8)).tostring())
+    return _unfilter_python(filter_type, line, prev, psize)
+
+
+def _unfilter_ndarray(filter_type, line, prev, psize, out):
+    """
+    Reverse a scanline filter of the array line into out, a row of a
+    NumPy array, for Reader.read_ndarray(). The prev argument is the
+    previous row of the same array, or None for the first one. As in
+    _unfilter_numpy(), average and Paeth are not vectorized.
+    """
+    data = numpy.frombuffer(line, numpy.uint8)
+    if filter_type == 0 or (filter_type == 2 and prev is None):
+        out[:] = data
+    elif filter_type == 1 or (filter_type == 4 and prev is None):
+        numpy.cumsum(data.reshape(-1, psize), axis=0, dtype=numpy.uint8,
+                     out=out.reshape(-1, psize))
+    elif filter_type == 2:
+        numpy.add(data, prev, out=out)
+    else:
+        # Average and Paeth depend on the reconstructed byte to the
+        # left, which NumPy cannot express for a whole row.
+        if prev is not None:
+            prev = array('B', prev.tostring())
+        out[:] = numpy.frombuffer(
+            _unfilter_python(filter_type, line, prev, psize), numpy.uint8)
+
+
+def _filter_ndarray(filter_type, line, prev, psize):
+    """
+    Apply a scanline filter to line, a row of a NumPy array of bytes,
+    with the previous row prev (zeros for the first one), and return
+    the filtered row, for Writer.write_ndarray().
+    """
+    # http://www.w3.org/TR/PNG/#9Filter-types
+    if filter_type == 0:
+        return line
+    left = numpy.zeros_like(line)
+    left[psize:] = line[:-psize]
+    if filter_type == 1:
+        return line - left
+    if filter_type == 2:
+        return line - prev
+    if filter_type == 3:
+        return line - ((left.astype(numpy.uint16) + prev) >> 1).astype(
+            numpy.uint8)
+    # Unlike reversing it, the Paeth filter only depends on the
+    # unfiltered bytes, so it works on the whole row at once.
+    a = left.astype(numpy.int16)
+    b = prev.astype(numpy.int16)
+    c = numpy.zeros_like(b)
+    c[psize:] = b[:-psize]
+    pa = abs(b - c)
+    pb = abs(a - c)
+    pc = abs(a + b - c - c)
+    predictor = numpy.where((pa <= pb) & (pa <= pc), a,
+                            numpy.where(pb <= pc, b, c))
+    return line - predictor.astype(numpy.uint8)
+
+
+def _choose_ndarray(filter_type, line, prev, psize):
+    """
+    Apply a filter type, or the best one for 'adaptive', to a row of
+    a NumPy array of bytes like _filter_ndarray(), and return the
+    filter type and the filtered row.
+    """
+    if filter_type != 'adaptive':
+        return filter_type, _filter_ndarray(filter_type, line, prev, psize)
+    # The same heuristic as in Writer.filter_scanline().
+    best = None
+    for candidate in range(5):
+        filtered = _filter_ndarray(candidate, line, prev, psize)
+        signed = filtered.astype(numpy.int16)
+        total = numpy.minimum(signed, 256 - signed).sum()
+        if best is None or total < best_sum:
+            best, filter_type, best_sum = filtered, candidate, total
+    return filter_type, best
+
+
+_unfilter_backends = {'python': _unfilter_python}
+if numpy is not None:
+    _unfilter_backends['numpy'] = _unfilter_numpy
+
+# The unfilter implementation used by Reader, one of the keys in
+# _unfilter_backends. All of them give the same results.
+if numpy is not None:
+    unfilter_backend = 'numpy'
+else:
+    unfilter_backend = 'python'
+
+
+def _deflate_strip(data, settings):
+    """
+    Compress a strip of image data as raw deflate data that ends on a
+    byte boundary, return it with the Adler-32 checksum and length of
+    the input. The settings come from Writer.zlib_settings().
+    """
+    level, window_bits, mem_level, strategy = settings
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits,
+                                  mem_level, strategy)
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data) & 0xffffffff, len(data)
+
+
+def _adler32_combine(adler1, adler2, length2):
+    """
+    Return the Adler-32 checksum of two concatenated strings, given
+    both checksums and the length of the second string.
+    """
+    # Same as adler32_combine() in zlib, which Python does not expose.
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) +
+            base - remainder) % base
+    return sum1 | (sum2 << 16)
+
+
+def _row_samples(row, bytes_per_sample):
+    """
+    Return the samples in a row of bytes, which are big-endian pairs
+    for 16-bit images, as an array of integers.
+    """
+    if bytes_per_sample == 1:
+        return row
+    samples = array('H')
+    samples.fromstring(buffer(row))
+    if sys.byteorder == 'little':
+        samples.byteswap()
+    return samples
+
+
+def _sample_bytes(data):
+    """
+    Return an array of 16-bit samples ('H') with native integers as a
+    string of big-endian pairs of bytes, without changing the array.
+    Other data is returned as it is.
+    """
+    if not isinstance(data, array) or data.typecode != 'H':
+        return data
+    # http://www.w3.org/TR/PNG/#7Integers-and-byte-order
+    if sys.byteorder == 'little':
+        data = data[:]
+        data.byteswap()
+    return data.tostring()
+
+
+def _samples_to_bytes(samples, bytes_per_sample):
+    """
+    Return a sequence of sample values as an array of bytes, with
+    big-endian pairs for 16-bit images.
+    """
+    if bytes_per_sample == 1:
+        return array('B', samples)
+    samples = array('H', samples)
+    if sys.byteorder == 'little':
+        samples.byteswap()
+    return array('B', samples.tostring())
+
+
+def _make_bit_tables(bitdepth):
+    """
+    Return string.translate() tables to pack samples of bitdepth bits
+    into their place in a byte, and to unpack them, one table for each
+    place from the highest bits to the lowest.
+    """
+    mask = (1 << bitdepth) - 1
+    pack = []
+    unpack = []
+    for place in range(8 // bitdepth):
+        shift = 8 - bitdepth * (place + 1)
+        pack.append(''.join([chr((v & mask) << shift) for v in range(256)]))
+        unpack.append(''.join([chr((v >> shift) & mask) for v in range(256)]))
+    return pack, unpack
+
+_bit_tables = dict([(bitdepth, _make_bit_tables(bitdepth))
+                    for bitdepth in (1, 2, 4)])
+
+
+def _pack_bits(samples, bitdepth):
+    """
+    Pack a row of samples with one byte each into bytes with samples
+    of bitdepth bits, first sample in the highest bits. The last byte
+    is padded with zero bits.
+    """
+    # http://www.w3.org/TR/PNG/#7Scanline
+    if not isinstance(samples, str):
+        samples = _as_array(samples).tostring()
+    if samples and ord(max(samples)) >> bitdepth:
+        raise ValueError("sample value does not fit in %d bits" % bitdepth)
+    per_byte = 8 // bitdepth
+    samples += '\0' * (-len(samples) % per_byte)
+    length = len(samples) // per_byte
+    # The shifted samples do not overlap, so they are combined with
+    # a bitwise or over the whole row.
+    packed = 0
+    for place, table in enumerate(_bit_tables[bitdepth][0]):
+        packed |= _row_to_long(samples[place::per_byte].translate(table))
+    return _long_to_row(packed, length)
+
+
+def _unpack_bits(data, bitdepth, count):
+    """
+    Unpack count samples of bitdepth bits from a row of bytes, return
+    an array with one byte for each sample.
+    """
+    if isinstance(data, array):
+        data = data.tostring()
+    per_byte = 8 // bitdepth
+    samples = array('B', [0]) * (len(data) * per_byte)
+    for place, table in enumerate(_bit_tables[bitdepth][1]):
+        samples[place::per_byte] = array('B', data.translate(table))
+    del samples[count:]
+    return samples
+
+
+# The 8-bit values that are exact multiples of the levels of a smaller
+# bit depth, http://www.w3.org/TR/PNG/#13Sample-depth-rescaling
+_grey_levels = dict([(bitdepth, ''.join([chr(v * 255 // (2 ** bitdepth - 1))
+                                         for v in range(2 ** bitdepth)]))
+                     for bitdepth in (1, 2, 4)])
+
+
+def _palette_tables(palette):
+    """
+    Return a string.translate() table for each sample of the palette
+    entries, to map indices to sample values.
+    """
+    tables = []
+    for i in range(len(palette[0])):
+        table = ''.join([chr(entry[i]) for entry in palette])
+        tables.append(table + '\0' * (256 - len(table)))
+    return tables
+
+
+def _expand_indices(indices, tables):
+    """
+    Return an array with the samples of the palette entries for an
+    array or string of indices, given the tables from _palette_tables.
+    """
+    if isinstance(indices, array):
+        indices = indices.tostring()
+    planes = len(tables)
+    pixels = array('B', [0]) * (len(indices) * planes)
+    for i, table in enumerate(tables):
+        pixels[i::planes] = array('B', indices.translate(table))
+    return pixels
+
+
 class Error(Exception):
     pass
 
 
+class FormatError(Error, ValueError):
+    """
+    Problem with the structure of the PNG data, such as a truncated
+    chunk. It is also a ValueError, which was raised before.
+    """
+
+
+class Stats:
+    """
+    Time and counters for the stages of encoding or decoding images,
+    collected by a Writer or Reader created with stats=Stats().
+
+    Attributes:
+    times - seconds spent in each stage, by stage name
+    zlib_in, zlib_out - bytes that went into and came out of zlib
+    idat_chunks - number of IDAT chunks
+    filter_types - number of scanlines with each filter type (0-4)
+    peak_buffer - size of the largest buffer of image data in bytes
+
+    The stages of a writer are 'scanlines' (getting the scanlines from
+    the caller), 'analysis' (for shrink and palette='auto'), 'filter',
+    'deflate', 'chunks' (checksums and chunk assembly), 'trials' (the
+    trial compressions of write_optimized()) and 'output'.
+    The stages of a reader are 'input', 'crc', 'inflate' and
+    'unfilter'. Each stage only counts its own time, not the time of
+    other stages that it waits for. One object can collect the totals
+    of many images, and without one nothing is measured.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.zlib_in = 0
+        self.zlib_out = 0
+        self.idat_chunks = 0
+        self.filter_types = [0] * 5
+        self.peak_buffer = 0
+        # All time added so far, to take nested stages out.
+        self.recorded = 0.0
+
+    def add(self, stage, seconds):
+        """
+        Add seconds to the time of a stage.
+        """
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+        self.recorded += seconds
+
+    def buffer(self, size):
+        """
+        Record a buffer of image data of size bytes.
+        """
+        if size > self.peak_buffer:
+            self.peak_buffer = size
+
+    def call(self, stage, function, *args):
+        """
+        Call function(*args), add its time to stage and return the
+        result.
+        """
+        recorded = self.recorded
+        start = time.time()
+        result = function(*args)
+        self.add(stage, time.time() - start - (self.recorded - recorded))
+        return result
+
+    def timed(self, stage, iterable):
+        """
+        Generator for the items of iterable, adding the time it takes
+        to produce them to stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            recorded = self.recorded
+            start = time.time()
+            try:
+                item = iterator.next()
+            finally:
+                self.add(stage,
+                         time.time() - start - (self.recorded - recorded))
+            yield item
+
+    def counted(self, lines):
+        """
+        Generator for the (filter_type, line) pairs of lines, counting
+        the filter types and the bytes for zlib.
+        """
+        for filter_type, line in lines:
+            self.filter_types[filter_type] += 1
+            self.zlib_in += 1 + len(line)
+            yield filter_type, line
+
+    def __str__(self):
+        lines = ['%-10s %9.4f s' % (stage, seconds)
+                 for stage, seconds in sorted(self.times.items())]
+        lines.append('zlib       %d bytes in, %d bytes out'
+                     % (self.zlib_in, self.zlib_out))
+        lines.append('IDAT       %d chunks' % self.idat_chunks)
+        lines.append('filters    ' + ' '.join(
+            '%s=%d' % (name, count)
+            for name, count in zip(_filter_names, self.filter_types)))
+        lines.append('buffer     %d bytes peak' % self.peak_buffer)
+        return '\n'.join(lines)
+
+
 class Writer:
     """
     PNG encoder in pure Python.
@@ -114,7 +694,17 @@ class Writer:
                  bytes_per_sample=1,
                  compression=None,
                  interlaced=False,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 filter_type=0,
+                 workers=1,
+                 palette=None,
+                 bits_per_sample=None,
+                 shrink=False,
+                 strategy=None,
+                 mem_level=None,
+                 window_bits=None,
+                 idat_size=None,
+                 stats=None):
         """
         Create a PNG encoder object.
 
@@ -128,6 +718,16 @@ class Writer:
         bytes_per_sample - 8-bit or 16-bit input data
         compression - zlib compression level (1-9)
         chunk_limit - write multiple IDAT chunks to save memory
+        filter_type - scanline filter (0-4 or 'adaptive')
+        workers - number of threads for compression
+        palette - create a palette image (list of colours or 'auto')
+        bits_per_sample - 1, 2, 4, 8 or 16 bits instead of bytes_per_sample
+        shrink - use the smallest colour type and depth that fits the data
+        strategy - zlib strategy ('default', 'filtered', 'huffman', 'rle')
+        mem_level - zlib memory level (1-9)
+        window_bits - zlib window size (9-15)
+        idat_size - size of the IDAT chunks in bytes of compressed data
+        stats - a Stats object that collects time and counters
 
         If specified, the transparent and background parameters must
         be a tuple with three integer values for red, green, blue, or
@@ -135,6 +735,46 @@ class Writer:
 
         If specified, the gamma parameter must be a float value.
 
+        The filter_type parameter selects the same filter for every
+        scanline: 0 (none), 1 (sub), 2 (up), 3 (average), 4 (paeth).
+        The names from the PNG specification are accepted as well. With
+        'adaptive', each scanline gets the filter that yields the
+        minimum sum of absolute differences, as recommended in
+        http://www.w3.org/TR/PNG/#12Filter-selection
+
+        With more than one worker, the image data is split into strips
+        of chunk_limit bytes that are compressed in parallel. This makes
+        the output a little larger, because matches cannot reach back
+        into the previous strip.
+
+        Without idat_size, each IDAT chunk has the compressed data of
+        about chunk_limit bytes of image data, so its size depends on
+        how well the image compresses. With idat_size, the compressed
+        data is cut into IDAT chunks of exactly that size, except for
+        the last one.
+
+        If palette is a list of (r, g, b) or (r, g, b, alpha) tuples,
+        up to 256 of them, the input data has one byte per pixel with
+        the index into the palette, and background is an index too.
+        With palette='auto', the input data is greyscale or RGB as
+        usual, and is written as a palette image if it has no more than
+        256 colours, including the transparent and background colours.
+        The palette is collected while the pixels are written, and
+        the image gets the smallest bit depth that fits the palette.
+
+        Greyscale images without alpha and palette images can have
+        1, 2 or 4 bits per sample. The input data still has one byte
+        per sample, which must fit into the bits; the samples are
+        packed when the scanlines are filtered.
+
+        With shrink, the pixels are checked before anything is written,
+        and the image is stored without an alpha channel that is
+        always opaque, as greyscale if red, green and blue are always
+        equal, with 8 instead of 16 bits if both bytes of every sample
+        are equal, and with 1, 2 or 4 bits if the greyscale values are
+        exact multiples of the levels. The reductions list attribute
+        describes what was done after each write.
+
         """
         if width <= 0 or height <= 0:
             raise ValueError("width and height must be greater than zero")
@@ -143,9 +783,24 @@ class Writer:
             raise ValueError(
                 "transparent color not allowed with alpha channel")
 
+        if bits_per_sample is None:
+            bits_per_sample = bytes_per_sample * 8
+        else:
+            if bits_per_sample not in (1, 2, 4, 8, 16):
+                raise ValueError("bits per sample must be 1, 2, 4, 8 or 16")
+            bytes_per_sample = max(1, bits_per_sample // 8)
+
         if bytes_per_sample < 1 or bytes_per_sample > 2:
             raise ValueError("bytes per sample must be 1 or 2")
 
+        # http://www.w3.org/TR/PNG/#table111
+        if bits_per_sample < 8:
+            if palette == 'auto':
+                raise ValueError("palette='auto' chooses the bit depth")
+            if palette is None and (not greyscale or has_alpha):
+                raise ValueError("only greyscale and palette images can"
+                                 " have less than 8 bits per sample")
+
         if transparent is not None:
             if greyscale:
                 if type(transparent) is not int:
@@ -159,7 +814,7 @@ class Writer:
                     raise ValueError(
                         "transparent color must be a triple of integers")
 
-        if background is not None:
+        if background is not None and palette in (None, 'auto'):
             if greyscale:
                 if type(background) is not int:
                     raise ValueError(
@@ -172,6 +827,52 @@ class Writer:
                     raise ValueError(
                         "background color must be a triple of integers")
 
+        if filter_type in _filter_names:
+            filter_type = _filter_names.index(filter_type)
+        if filter_type not in (0, 1, 2, 3, 4, 'adaptive'):
+            raise ValueError(
+                "filter type must be 0-4, a filter name or 'adaptive'")
+
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        if strategy is None:
+            strategy = zlib.Z_DEFAULT_STRATEGY
+        if strategy in _strategy_names:
+            strategy = _strategy_names.index(strategy)
+        if strategy not in range(len(_strategy_names)):
+            raise ValueError("strategy must be 0-4 or a strategy name")
+        if mem_level is None:
+            mem_level = 8
+        if not 1 <= mem_level <= 9:
+            raise ValueError("mem_level must be 1-9")
+        if window_bits is None:
+            window_bits = zlib.MAX_WBITS
+        if not 9 <= window_bits <= zlib.MAX_WBITS:
+            raise ValueError("window_bits must be 9-15")
+
+        if shrink and (palette is not None or bits_per_sample < 8):
+            raise ValueError("shrink is only for 8-bit and 16-bit samples"
+                             " without a palette")
+
+        if palette is not None:
+            if bytes_per_sample != 1:
+                raise ValueError("palette images must have 8-bit samples")
+            if palette != 'auto':
+                if greyscale or has_alpha or transparent is not None:
+                    raise ValueError("palette images have palette colours")
+                if not 0 < len(palette) <= 2 ** bits_per_sample:
+                    raise ValueError("palette must have 1 to %d colours"
+                                     % 2 ** bits_per_sample)
+                for entry in palette:
+                    if len(entry) not in (3, 4) or \
+                       min(entry) < 0 or max(entry) > 255:
+                        raise ValueError(
+                            "palette colours must be 3 or 4 values 0-255")
+                if background is not None and \
+                   not 0 <= background < len(palette):
+                    raise ValueError("background must be a palette index")
+
         self.width = width
         self.height = height
         self.transparent = transparent
@@ -180,11 +881,26 @@ class Writer:
         self.greyscale = greyscale
         self.has_alpha = has_alpha
         self.bytes_per_sample = bytes_per_sample
+        self.bits_per_sample = bits_per_sample
         self.compression = compression
         self.chunk_limit = chunk_limit
         self.interlaced = interlaced
-
-        if self.greyscale:
+        self.filter_type = filter_type
+        self.workers = workers
+        self.palette = palette
+        self.shrink = shrink
+        self.reductions = []
+        self.strategy = strategy
+        self.mem_level = mem_level
+        self.window_bits = window_bits
+        self.idat_size = idat_size
+        self.stats = stats
+
+        if self.palette not in (None, 'auto'):
+            self.color_depth = 1
+            self.color_type = 3
+            self.psize = 1
+        elif self.greyscale:
             self.color_depth = 1
             if self.has_alpha:
                 self.color_type = 4
@@ -206,16 +922,249 @@ class Writer:
         Write a PNG chunk to the output file, including length and checksum.
         """
         # http://www.w3.org/TR/PNG/#5Chunk-layout
-        outfile.write(struct.pack("!I", len(data)))
-        outfile.write(tag)
-        outfile.write(data)
-        checksum = zlib.crc32(tag)
-        checksum = zlib.crc32(data, checksum)
-        outfile.write(struct.pack("!i", checksum))
+        if not isinstance(data, str):
+            data = str(buffer(data))
+        checksum = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
+        # One write per chunk, because the output may be an unbuffered
+        # pipe or socket.
+        outfile.write(''.join((struct.pack("!I", len(data)), tag, data,
+                               struct.pack("!I", checksum))))
 
     def write(self, outfile, scanlines):
         """
         Write a PNG image to the output file.
+
+        For an interlaced image, the scanlines must come in the order
+        of the Adam7 passes; see write_rows for image rows.
+
+        With two bytes per sample, a scanline can be an array('H') of
+        native integers instead of big-endian pairs of bytes. This
+        works for all write methods.
+        """
+        self.write_pieces(outfile, self.encode(scanlines))
+
+    def write_rows(self, outfile, rows):
+        """
+        Write a PNG image to the output file, from rows in top to
+        bottom order.
+
+        For an interlaced image, the rows are split into the Adam7
+        passes as they arrive. Each pass is compressed separately into
+        a temporary file, so memory use does not grow with the image.
+        """
+        self.write_pieces(outfile, self.encode_rows(rows))
+
+    def write_pieces(self, outfile, pieces):
+        """
+        Write the pieces of PNG data from encode() to the output file.
+        """
+        if self.stats is None:
+            for data in pieces:
+                outfile.write(data)
+        else:
+            for data in pieces:
+                self.stats.call('output', outfile.write, data)
+
+    def encode(self, scanlines):
+        """
+        Generator for the PNG data of an image, in the pieces that
+        write() would write: the chunks before the image data, each
+        IDAT chunk, and IEND.
+
+        Nothing is done until the next piece is requested, and each
+        piece takes the work for about chunk_limit bytes of image data
+        (all of it first with shrink or palette='auto'), so a program
+        with an event loop can send the pieces as the client accepts
+        them, and close() the generator to stop in the middle.
+        """
+        writer, scanlines = self.choose_writer(
+            self.sample_scanlines(scanlines))
+        for data in writer.encode_chunks(writer.deflate_scanlines(scanlines)):
+            yield data
+
+    def encode_rows(self, rows):
+        """
+        Generator for the PNG data of an image from rows in top to
+        bottom order, like encode() for write_rows().
+        """
+        writer, rows = self.choose_writer(self.sample_scanlines(rows))
+        if writer.interlaced:
+            compressed = writer.deflate_interlaced(rows)
+            if self.stats is not None:
+                compressed = self.stats.timed('deflate', compressed)
+        else:
+            compressed = writer.deflate_scanlines(rows)
+        for data in writer.encode_chunks(compressed):
+            yield data
+
+    def sample_scanlines(self, scanlines):
+        """
+        Return the scanlines with arrays of 16-bit samples converted
+        to strings of big-endian pairs of bytes, with the C-level
+        byteswap() of each row.
+        """
+        if self.bytes_per_sample != 2:
+            return scanlines
+        return (_sample_bytes(scanline) for scanline in scanlines)
+
+    def choose_writer(self, scanlines):
+        """
+        Return the writer for the scanlines and the scanlines for it,
+        from choose_reductions() or choose_palette() if shrink or
+        palette='auto' are set, otherwise this writer and the same
+        scanlines.
+        """
+        stats = self.stats
+        if stats is not None:
+            scanlines = stats.timed('scanlines', scanlines)
+        if self.shrink:
+            choose = self.choose_reductions
+        elif self.palette == 'auto':
+            choose = self.choose_palette
+        else:
+            return self, scanlines
+        if stats is None:
+            return choose(scanlines)
+        writer, scanlines = stats.call('analysis', choose, scanlines)
+        return writer, stats.timed('analysis', scanlines)
+
+    def encode_chunks(self, compressed_strips):
+        """
+        Generator for the PNG data around the compressed image data.
+        """
+        out = _pieces()
+        self.write_preamble(out)
+        yield out.take()
+        for data in self.encode_idat(compressed_strips):
+            yield data
+        # http://www.w3.org/TR/PNG/#11IEND
+        self.write_chunk(out, 'IEND', '')
+        yield out.take()
+
+    def encode_idat(self, compressed_strips):
+        """
+        Generator for the IDAT chunks with the compressed image data,
+        in chunks of idat_size bytes if it is set.
+        """
+        out = _pieces()
+        # http://www.w3.org/TR/PNG/#11IDAT
+        if self.idat_size:
+            compressed_strips = _resize_pieces(compressed_strips,
+                                               self.idat_size)
+        stats = self.stats
+        for compressed in compressed_strips:
+            if not len(compressed):
+                continue
+            if stats is None:
+                self.write_chunk(out, 'IDAT', compressed)
+            else:
+                stats.zlib_out += len(compressed)
+                stats.idat_chunks += 1
+                stats.buffer(len(compressed))
+                stats.call('chunks', self.write_chunk, out, 'IDAT', compressed)
+            yield out.take()
+
+    def write_optimized(self, outfile, scanlines, trials=None,
+                        workers=None, threshold=None):
+        """
+        Write a PNG image to the output file like write(), with the
+        filter type and zlib settings that give the smallest file.
+
+        Each trial is a (filter_type, level, strategy, mem_level,
+        window_bits) tuple; by default every filter type is tried with
+        level 9, all strategies except 'fixed', and memory levels 8 and
+        9. The trials for each filter type are a round that filters
+        the scanlines once and compresses them with each setting.
+        Rounds run in a pool of worker processes (default: number of
+        CPUs), and the compressed data of the best trial is written
+        as it is. The writer keeps the best settings afterwards.
+
+        With a threshold, the rounds are checked in order, and no more
+        rounds are started once a round makes the image smaller by
+        less than threshold bytes. Put the most promising filter types
+        first. Return a list of (size, trial) pairs, smallest first.
+        """
+        writer, scanlines = self.choose_writer(
+            self.sample_scanlines(scanlines))
+        if writer is not self:
+            return writer.write_optimized(outfile, scanlines, trials,
+                                          workers, threshold)
+        if trials is None:
+            trials = [(filter_type, 9, strategy, mem_level, zlib.MAX_WBITS)
+                      for filter_type in ('adaptive', 0, 4, 1, 2, 3)
+                      for strategy in (0, 1, 3, 2)
+                      for mem_level in (9, 8)]
+        rounds = []
+        for filter_type, level, strategy, mem_level, window_bits in trials:
+            if filter_type in _filter_names:
+                filter_type = _filter_names.index(filter_type)
+            if strategy in _strategy_names:
+                strategy = _strategy_names.index(strategy)
+            if not rounds or rounds[-1][0] != filter_type:
+                rounds.append((filter_type, []))
+            rounds[-1][1].append((level, strategy, mem_level, window_bits))
+        # Strings are much faster to send to the worker processes.
+        scanlines = [isinstance(scanline, str) and scanline or
+                     _as_array(scanline).tostring()
+                     for scanline in scanlines]
+
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        pool = None
+        tasks = [(self, filter_type, settings)
+                 for filter_type, settings in rounds]
+        if workers == 1:
+            _set_trial_scanlines(scanlines)
+            results = (_trial_round(task) for task in tasks)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(workers, len(tasks)),
+                                        _set_trial_scanlines, (scanlines, ))
+            results = pool.imap(_trial_round, tasks)
+        tried = []
+        best = None
+        start = time.time()
+        try:
+            for sizes, pieces, counts in results:
+                tried.extend(sizes)
+                size, trial = min(sizes)
+                if best is None or size < best[0]:
+                    gain = best and best[0] - size
+                    best = size, trial, pieces, counts
+                else:
+                    gain = 0
+                if threshold is not None and gain is not None and \
+                   gain < threshold:
+                    break
+        finally:
+            _set_trial_scanlines(None)
+            if pool is not None:
+                pool.terminate()
+
+        size, trial, pieces, counts = best
+        if self.stats is not None:
+            self.stats.add('trials', time.time() - start)
+            self.stats.zlib_in += counts.zlib_in
+            self.stats.filter_types = map(add, self.stats.filter_types,
+                                          counts.filter_types)
+        (self.filter_type, self.compression, self.strategy,
+         self.mem_level, self.window_bits) = trial
+        self.write_pieces(outfile, self.encode_chunks(pieces))
+        tried.sort()
+        return tried
+
+    def write_idat(self, outfile, compressed_strips):
+        """
+        Write IDAT chunks with the compressed image data.
+        """
+        self.write_pieces(outfile, self.encode_idat(compressed_strips))
+
+    def write_preamble(self, outfile):
+        """
+        Write the PNG signature and the chunks before the image data.
         """
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
         outfile.write(struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10))
@@ -227,14 +1176,35 @@ class Writer:
             interlaced = 0
         self.write_chunk(outfile, 'IHDR',
                          struct.pack("!2I5B", self.width, self.height,
-                                     self.bytes_per_sample * 8,
+                                     self.bits_per_sample,
                                      self.color_type, 0, 0, interlaced))
 
+        # http://www.w3.org/TR/PNG/#11gAMA
+        if self.gamma is not None:
+            self.write_chunk(outfile, 'gAMA',
+                             struct.pack("!L", int(self.gamma * 100000)))
+
+        # http://www.w3.org/TR/PNG/#11PLTE
+        if self.color_type == 3:
+            self.write_chunk(outfile, 'PLTE', ''.join(
+                [struct.pack("3B", *entry[:3]) for entry in self.palette]))
+            # The tRNS chunk can omit the opaque entries at the end.
+            alphas = [(entry + (255, ))[3] for entry in self.palette]
+            while alphas and alphas[-1] == 255:
+                alphas.pop()
+            if alphas:
+                self.write_chunk(outfile, 'tRNS',
+                                 struct.pack("%dB" % len(alphas), *alphas))
+            if self.background is not None:
+                self.write_chunk(outfile, 'bKGD',
+                                 struct.pack("B", self.background))
+            return
+
         # http://www.w3.org/TR/PNG/#11tRNS
         if self.transparent is not None:
             if self.greyscale:
                 self.write_chunk(outfile, 'tRNS',
-                                 struct.pack("!1H", *self.transparent))
+                                 struct.pack("!1H", self.transparent))
             else:
                 self.write_chunk(outfile, 'tRNS',
                                  struct.pack("!3H", *self.transparent))
@@ -243,93 +1213,775 @@ class Writer:
         if self.background is not None:
             if self.greyscale:
                 self.write_chunk(outfile, 'bKGD',
-                                 struct.pack("!1H", *self.background))
+                                 struct.pack("!1H", self.background))
             else:
                 self.write_chunk(outfile, 'bKGD',
                                  struct.pack("!3H", *self.background))
 
-        # http://www.w3.org/TR/PNG/#11gAMA
-        if self.gamma is not None:
-            self.write_chunk(outfile, 'gAMA',
-                             struct.pack("!L", int(self.gamma * 100000)))
+    def choose_palette(self, scanlines):
+        """
+        Collect the colours of the scanlines for palette='auto'.
+
+        Return a writer for a palette image and a generator for the
+        scanlines as palette indices, or, if there are more than 256
+        colours, a writer without a palette and a generator for the
+        original scanlines.
+
+        The colours are mapped to indices with a dictionary as the
+        scanlines arrive. The index scanlines are kept in a temporary
+        file that stays in memory up to chunk_limit bytes; if there
+        turn out to be too many colours, they are mapped back to the
+        original colours from the palette collected so far.
+        """
+        planes = self.psize
+        colours = {}
+        if self.background is not None:
+            background = self.background
+            if self.greyscale:
+                background = (background, )
+            colours[tuple(background) + (255, ) * self.has_alpha] = 0
+        spill = tempfile.SpooledTemporaryFile(self.chunk_limit)
+        lengths = []
+        scanlines = iter(scanlines)
+        overflow = None
+        for scanline in scanlines:
+            scanline = _as_array(scanline)
+            keys = zip(*[scanline[i::planes] for i in range(planes)])
+            for key in sorted(set(keys).difference(colours)):
+                colours[key] = len(colours)
+            if len(colours) > 256:
+                overflow = scanline
+                break
+            spill.write(array('B', map(colours.__getitem__, keys)).tostring())
+            lengths.append(len(keys))
+        keys = sorted(colours, key=colours.get)[:256]
+        spill.seek(0)
+
+        if overflow is not None:
+            writer = Writer(self.width, self.height,
+                            transparent=self.transparent,
+                            background=self.background,
+                            gamma=self.gamma,
+                            greyscale=self.greyscale,
+                            has_alpha=self.has_alpha,
+                            compression=self.compression,
+                            interlaced=self.interlaced,
+                            chunk_limit=self.chunk_limit,
+                            filter_type=self.filter_type,
+                            workers=self.workers,
+                            strategy=self.strategy,
+                            mem_level=self.mem_level,
+                            window_bits=self.window_bits,
+                            idat_size=self.idat_size,
+                            stats=self.stats)
+            tables = _palette_tables(keys)
+
+            def original():
+                for length in lengths:
+                    yield _expand_indices(spill.read(length), tables)
+                spill.close()
+                yield overflow
+                for scanline in scanlines:
+                    yield scanline
+            return writer, original()
+
+        transparent = self.transparent
+        if self.greyscale and transparent is not None:
+            transparent = (transparent, )
+        entries = []
+        for key in keys:
+            if self.has_alpha:
+                colour, alpha = key[:-1], key[-1]
+            else:
+                colour, alpha = key, 255
+                if transparent is not None and key == tuple(transparent):
+                    alpha = 0
+            if self.greyscale:
+                colour = colour * 3
+            entries.append((colour, alpha))
+        # Entries with transparency go first, to keep tRNS short.
+        order = sorted(range(len(entries)),
+                       key=lambda i: (entries[i][1] == 255, i))
+        palette = [entries[i][0] + (entries[i][1], ) for i in order]
+        remap = [0] * 256
+        for index, i in enumerate(order):
+            remap[i] = index
+        remap = ''.join(map(chr, remap))
+        # The smallest bit depth with enough indices for the palette.
+        bits_per_sample = 1
+        while len(palette) > 2 ** bits_per_sample:
+            bits_per_sample *= 2
+        background = None
+        if self.background is not None:
+            background = ord(remap[0])
+        writer = Writer(self.width, self.height,
+                        background=background,
+                        gamma=self.gamma,
+                        compression=self.compression,
+                        interlaced=self.interlaced,
+                        chunk_limit=self.chunk_limit,
+                        filter_type=self.filter_type,
+                        workers=self.workers,
+                        palette=palette,
+                        bits_per_sample=bits_per_sample,
+                        strategy=self.strategy,
+                        mem_level=self.mem_level,
+                        window_bits=self.window_bits,
+                        idat_size=self.idat_size,
+                        stats=self.stats)
+
+        def indices():
+            for length in lengths:
+                yield array('B', spill.read(length).translate(remap))
+            spill.close()
+        return writer, indices()
+
+    def choose_reductions(self, scanlines):
+        """
+        Check the scanlines for a shrink writer. Return a writer for
+        the smallest colour type and bit depth that can store the
+        pixels without loss, and a generator for the scanlines in that
+        format. The reductions attribute lists what has been changed.
+
+        Each scanline is checked with comparisons of whole slices, and
+        kept in a temporary file that stays in memory up to
+        chunk_limit bytes, until the image header can be written. The
+        checks stop as soon as nothing can be reduced.
+        """
+        psize = self.psize
+        bps = self.bytes_per_sample
+        planes = psize // bps
+        opaque = self.has_alpha
+        grey = not self.greyscale
+        eight = bps == 2
+        depths = [1, 2, 4]
+        spill = tempfile.SpooledTemporaryFile(self.chunk_limit)
+        lengths = []
+        scanlines = iter(scanlines)
+        for scanline in scanlines:
+            row = _as_array(scanline)
+            spill.write(row.tostring())
+            lengths.append(len(row))
+            if opaque:
+                alpha = (planes - 1) * bps
+                opaque = min(row[alpha:len(row):psize]) == 255 and \
+                    min(row[alpha + bps - 1:len(row):psize]) == 255
+            if grey:
+                for i in range(bps):
+                    red = row[i::psize]
+                    if red != row[i + bps::psize] or \
+                       red != row[i + 2 * bps::psize]:
+                        grey = False
+            if eight:
+                eight = row[0::2] == row[1::2]
+            # Fewer bits are only possible for greyscale without alpha.
+            if not ((self.greyscale or grey) and
+                    (opaque or not self.has_alpha) and (bps == 1 or eight)):
+                depths = []
+            if depths:
+                values = row[0::psize].tostring()
+                depths = [depth for depth in depths
+                          if not values.translate(None, _grey_levels[depth])]
+            if not (opaque or grey or eight or depths):
+                break
 
-        # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
-        else:
-            compressor = zlib.compressobj()
+        # The transparent and background colours must fit as well.
+        colours = []
+        for colour in self.transparent, self.background:
+            if colour is not None and self.greyscale:
+                colour = (colour, )
+            colours.append(colour)
+        given = [colour for colour in colours if colour is not None]
+        if grey:
+            grey = not [colour for colour in given
+                        if colour[0] != colour[1] or colour[0] != colour[2]]
+        if eight:
+            eight = not [colour for colour in given
+                         if [v for v in colour if v % 257]]
+        greyscale = self.greyscale or grey
+        has_alpha = self.has_alpha and not opaque
+        bits_per_sample = 8 * bps
+        if eight:
+            bits_per_sample = 8
+        if depths and greyscale and not has_alpha and bits_per_sample == 8:
+            for depth in depths:
+                step = 255 // (2 ** depth - 1) * (bps == 2 and 257 or 1)
+                if not [colour for colour in given if colour[0] % step]:
+                    bits_per_sample = depth
+                    break
+
+        self.reductions = []
+        if self.has_alpha and not has_alpha:
+            self.reductions.append("removed opaque alpha channel")
+        if greyscale and not self.greyscale:
+            self.reductions.append("converted to greyscale")
+        if bits_per_sample != 8 * bps:
+            self.reductions.append("reduced from %d to %d bits per sample"
+                                   % (8 * bps, bits_per_sample))
+
+        # The samples to keep, and the bytes of each sample to keep.
+        channels = range(planes - self.has_alpha)
+        if greyscale:
+            channels = [0]
+        if has_alpha:
+            channels.append(planes - 1)
+        keep = [channel * bps + i for channel in channels
+                for i in range(bits_per_sample > 8 and 2 or 1)]
+        step = 255 // (2 ** min(bits_per_sample, 8) - 1)
+        levels = ''.join([chr(v // step) for v in range(256)])
+        scale = (2 ** (8 * bps) - 1) // (2 ** bits_per_sample - 1)
+        for i, colour in enumerate(colours):
+            if colour is not None:
+                colour = tuple([colour[channel] // scale
+                                for channel in channels
+                                if channel < len(colour)])
+                if greyscale:
+                    colour = colour[0]
+                colours[i] = colour
+        writer = Writer(self.width, self.height,
+                        transparent=colours[0],
+                        background=colours[1],
+                        gamma=self.gamma,
+                        greyscale=greyscale,
+                        has_alpha=has_alpha,
+                        bits_per_sample=bits_per_sample,
+                        compression=self.compression,
+                        interlaced=self.interlaced,
+                        chunk_limit=self.chunk_limit,
+                        filter_type=self.filter_type,
+                        workers=self.workers,
+                        strategy=self.strategy,
+                        mem_level=self.mem_level,
+                        window_bits=self.window_bits,
+                        idat_size=self.idat_size,
+                        stats=self.stats)
+        spill.seek(0)
+        changed = bool(self.reductions)
+
+        def reduce_row(row):
+            if not changed:
+                return row
+            row = _as_array(row)
+            count = len(row) // psize
+            reduced = array('B', [0]) * (count * len(keep))
+            for i, offset in enumerate(keep):
+                reduced[i::len(keep)] = row[offset::psize]
+            if bits_per_sample < 8:
+                reduced = array('B', reduced.tostring().translate(levels))
+            return reduced
+
+        def reduced():
+            for length in lengths:
+                yield reduce_row(array('B', spill.read(length)))
+            spill.close()
+            for scanline in scanlines:
+                yield reduce_row(scanline)
+        return writer, reduced()
+
+    def filtered_lines(self, scanlines):
+        """
+        Generator for the filtered image data, a (filter_type, line)
+        pair for each scanline. With filter type 0 the line is the
+        scanline itself, or an array of it if it is not a string,
+        buffer or array.
+        """
+        # The up, average and paeth filters must not look across the
+        # boundary between two Adam7 passes.
+        pass_starts = set([0])
+        if self.interlaced:
+            rows = 0
+            for xstart, ystart, xstep, ystep in _adam7:
+                if xstart >= self.width:
+                    continue
+                pass_starts.add(rows)
+                rows += len(range(ystart, self.height, ystep))
+
+        prev = None
+        for row, scanline in enumerate(scanlines):
+            if self.bits_per_sample < 8:
+                scanline = _pack_bits(scanline, self.bits_per_sample)
+            if self.filter_type == 0:
+                if not isinstance(scanline, (str, buffer, array)):
+                    scanline = array('B', scanline)
+                yield 0, scanline
+            else:
+                if row in pass_starts:
+                    prev = None
+                yield self.filter_scanline(scanline, prev)
+                prev = scanline
 
+    def filtered_strips(self, scanlines):
+        """
+        Generator for the filtered image data, in arrays of at least
+        chunk_limit bytes, except for the last one.
+        """
+        return self.join_strips(self.filtered_lines(scanlines))
+
+    def join_strips(self, lines):
+        """
+        Generator for the (filter_type, line) pairs from filtered_lines()
+        joined into arrays of at least chunk_limit bytes, except for the
+        last one.
+        """
         data = array('B')
-        for scanline in scanlines:
-            data.append(0)
-            data.extend(scanline)
+        for filter_type, line in lines:
+            data.append(filter_type)
+            if isinstance(line, array):
+                data.extend(line)
+            else:
+                data.fromstring(line)
             if len(data) > self.chunk_limit:
-                compressed = compressor.compress(data.tostring())
-                if len(compressed):
-                    # print >> sys.stderr, len(data), len(compressed)
-                    self.write_chunk(outfile, 'IDAT', compressed)
+                if self.stats is not None:
+                    self.stats.buffer(len(data))
+                yield data
                 data = array('B')
         if len(data):
-            compressed = compressor.compress(data.tostring())
+            yield data
+
+    def zlib_settings(self):
+        """
+        Return the zlib level, window bits, memory level and strategy.
+        """
+        level = self.compression
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return level, self.window_bits, self.mem_level, self.strategy
+
+    def compressor(self, raw=False):
+        """
+        Return a zlib compressor with the settings of the writer, for
+        raw deflate data without header and checksum if raw is true.
+        """
+        level, window_bits, mem_level, strategy = self.zlib_settings()
+        if raw:
+            window_bits = -window_bits
+        return zlib.compressobj(level, zlib.DEFLATED, window_bits,
+                                mem_level, strategy)
+
+    def zlib_header(self):
+        """
+        Return the two byte zlib header for the settings of the writer.
+        """
+        # http://www.ietf.org/rfc/rfc1950.txt
+        compressor = self.compressor()
+        return (compressor.compress('') + compressor.flush())[:2]
+
+    def deflate_scanlines(self, scanlines):
+        """
+        Return a generator for the compressed data of the scanlines,
+        with deflate_parallel() if there is more than one worker.
+        """
+        return self.deflate_lines(self.filtered_lines(scanlines))
+
+    def deflate_lines(self, lines):
+        """
+        Return a generator for the compressed data of the (filter_type,
+        line) pairs from filtered_lines(), with deflate_parallel() if
+        there is more than one worker.
+        """
+        stats = self.stats
+        if stats is not None:
+            lines = stats.counted(stats.timed('filter', lines))
+        if self.workers > 1:
+            compressed = self.deflate_parallel(self.join_strips(lines))
         else:
-            compressed = ''
-        flushed = compressor.flush()
-        if len(compressed) or len(flushed):
-            # print >> sys.stderr, len(data), len(compressed), len(flushed)
-            self.write_chunk(outfile, 'IDAT', compressed + flushed)
+            compressed = self.deflate(lines)
+        if stats is not None:
+            compressed = stats.timed('deflate', compressed)
+        return compressed
 
-        # http://www.w3.org/TR/PNG/#11IEND
-        self.write_chunk(outfile, 'IEND', '')
+    def deflate(self, lines):
+        """
+        Generator for the compressed image data of the (filter_type,
+        line) pairs from filtered_lines(), with one zlib stream for
+        all lines.
+
+        The lines go to the compressor as they are, without joining
+        them into strips first. The compressed data comes in pieces
+        for about chunk_limit bytes of image data each.
+        """
+        compressor = self.compressor()
+        compressed = []
+        held = None
+        size = 0
+        for filter_type, line in lines:
+            compressed.append(compressor.compress(_filter_bytes[filter_type]))
+            compressed.append(compressor.compress(line))
+            size += 1 + len(line)
+            if size > self.chunk_limit:
+                # The last piece is held back for the end of the stream.
+                if held is not None:
+                    yield held
+                held = ''.join(compressed)
+                compressed = []
+                size = 0
+        if held is not None and size:
+            yield held
+            held = None
+        compressed.append(compressor.flush())
+        yield (held or '') + ''.join(compressed)
+
+    def deflate_parallel(self, strips):
+        """
+        Generator for the compressed image data, with the strips
+        compressed by a pool of worker threads.
+
+        Each strip is compressed on its own and ends with a sync flush
+        on a byte boundary, so that the raw deflate data of all strips
+        can be joined into a single zlib stream. The Adler-32 checksum
+        of the stream is combined from the checksums of the strips.
+        """
+        from multiprocessing.pool import ThreadPool
+        settings = self.zlib_settings()
+        pool = ThreadPool(self.workers)
+
+        def finished():
+            # Only a few strips are kept in flight, to bound memory.
+            pending = []
+            for data in strips:
+                pending.append(pool.apply_async(_deflate_strip,
+                                                (data, settings)))
+                if len(pending) > 2 * self.workers:
+                    yield pending.pop(0).get()
+            for result in pending:
+                yield result.get()
+
+        header = self.zlib_header()
+        checksum = 1
+        compressed = None
+        try:
+            for strip, strip_checksum, length in finished():
+                checksum = _adler32_combine(checksum, strip_checksum, length)
+                if compressed is None:
+                    compressed = header + strip
+                else:
+                    yield compressed
+                    compressed = strip
+        finally:
+            pool.terminate()
+        # An empty final block and the checksum end the zlib stream.
+        final = self.compressor(raw=True)
+        yield compressed + final.flush() + struct.pack("!I", checksum)
+
+    def deflate_interlaced(self, rows):
+        """
+        Generator for the compressed data of an interlaced image, from
+        rows in top to bottom order.
+
+        Each Adam7 pass has its own compressor, which writes raw
+        deflate data to a temporary file that stays in memory up to
+        chunk_limit bytes. Only the last row of each pass is kept for
+        the filters. At the end the passes are flushed to a byte
+        boundary and joined in pass order into one zlib stream, with
+        the Adler-32 checksum combined from the checksums of the
+        passes.
+        """
+        passes = []
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            compressor = self.compressor(raw=True)
+            spill = tempfile.SpooledTemporaryFile(self.chunk_limit)
+            # Each pass keeps its previous row, checksum and length.
+            passes.append([xstart, ystart, xstep, ystep,
+                           compressor, spill, None, 1, 0])
+        y = -1
+        for y, row in enumerate(rows):
+            row = _as_array(row)
+            for state in passes:
+                xstart, ystart, xstep, ystep, compressor, spill = state[:6]
+                if y < ystart or (y - ystart) % ystep:
+                    continue
+                if xstep == 1:
+                    line = row
+                else:
+                    line = array('B', [0]) * (self.psize *
+                        ((self.width - xstart + xstep - 1) // xstep))
+                    skip = self.psize * xstep
+                    for i in range(self.psize):
+                        line[i::self.psize] = \
+                            row[xstart * self.psize + i::skip]
+                if self.bits_per_sample < 8:
+                    line = _pack_bits(line, self.bits_per_sample)
+                if self.filter_type == 0:
+                    filter_type, filtered = 0, line
+                elif self.stats is None:
+                    filter_type, filtered = self.filter_scanline(line,
+                                                                 state[6])
+                    state[6] = line
+                else:
+                    filter_type, filtered = self.stats.call(
+                        'filter', self.filter_scanline, line, state[6])
+                    state[6] = line
+                if self.stats is not None:
+                    self.stats.filter_types[filter_type] += 1
+                    self.stats.zlib_in += 1 + len(filtered)
+                for data in (_filter_bytes[filter_type], filtered):
+                    spill.write(compressor.compress(data))
+                    state[7] = zlib.adler32(data, state[7]) & 0xffffffff
+                state[8] += 1 + len(filtered)
+        if y + 1 != self.height:
+            raise ValueError("expected %d rows, got %d" % (self.height, y + 1))
+
+        compressed = self.zlib_header()
+        checksum = 1
+        for state in passes:
+            compressor, spill = state[4:6]
+            spill.write(compressor.flush(zlib.Z_SYNC_FLUSH))
+            checksum = _adler32_combine(checksum, state[7], state[8])
+            spill.seek(0)
+            while True:
+                compressed += spill.read(self.chunk_limit - len(compressed))
+                if len(compressed) < self.chunk_limit:
+                    break
+                yield compressed
+                compressed = ''
+            spill.close()
+        # An empty final block and the checksum end the zlib stream.
+        final = self.compressor(raw=True)
+        yield compressed + final.flush() + struct.pack("!I", checksum)
+
+    def _filter_sub(self, line, prev, x, b):
+        """
+        Apply sub filter.
+        """
+        length = len(line)
+        return _long_to_row(
+            _bytewise_sub(x, x >> (8 * self.psize), length), length)
+
+    def _filter_up(self, line, prev, x, b):
+        """
+        Apply up filter.
+        """
+        length = len(line)
+        return _long_to_row(_bytewise_sub(x, b, length), length)
+
+    def _filter_average(self, line, prev, x, b):
+        """
+        Apply average filter.
+        """
+        length = len(line)
+        average = _bytewise_average(x >> (8 * self.psize), b, length)
+        return _long_to_row(_bytewise_sub(x, average, length), length)
+
+    def _filter_paeth(self, line, prev, x, b):
+        """
+        Apply Paeth filter.
+        """
+        if numpy is not None:
+            return array('B', _filter_ndarray(
+                4, numpy.frombuffer(line, numpy.uint8),
+                numpy.frombuffer(prev, numpy.uint8), self.psize).tostring())
+        return _bytewise_paeth(line, prev, self.psize)
+
+    def filter_scanline(self, line, prev):
+        """
+        Apply the filter selected by filter_type to a scanline, return
+        the filter type byte and an array with the filtered scanline.
+
+        The prev argument is the unfiltered previous scanline of the
+        same pass, or None for the first scanline.
+        """
+        # http://www.w3.org/TR/PNG/#9Filter-types
+        line = _as_array(line)
+        if prev is None:
+            prev = array('B', [0]) * len(line)
+        else:
+            prev = _as_array(prev)
+        x = _row_to_long(line)
+        b = _row_to_long(prev)
+        filters = (None, self._filter_sub, self._filter_up,
+                   self._filter_average, self._filter_paeth)
+        if self.filter_type != 'adaptive':
+            return (self.filter_type,
+                    filters[self.filter_type](line, prev, x, b))
+        if numpy is not None:
+            filter_type, filtered = _choose_ndarray(
+                'adaptive', numpy.frombuffer(line, numpy.uint8),
+                numpy.frombuffer(prev, numpy.uint8), self.psize)
+            return filter_type, array('B', filtered.tostring())
+        best = line
+        best_type = 0
+        best_sum = _signed_abs_sum(line)
+        for filter_type in range(1, 5):
+            filtered = filters[filter_type](line, prev, x, b)
+            total = _signed_abs_sum(filtered)
+            if total < best_sum:
+                best, best_type, best_sum = filtered, filter_type, total
+        return best_type, best
 
     def write_array(self, outfile, pixels):
         """
         Encode a pixel array to PNG and write output file.
         """
+        pixels = _sample_bytes(pixels)
         if self.interlaced:
             self.write(outfile, self.array_scanlines_interlace(pixels))
         else:
             self.write(outfile, self.array_scanlines(pixels))
 
+    def write_ndarray(self, outfile, pixels):
+        """
+        Encode a NumPy array to PNG and write output file.
+
+        The array has the shape (height, width, planes), or (height,
+        width) for one plane, and the dtype uint8, or uint16 in any
+        byte order for images with two bytes per sample. The rows of a
+        non-interlaced image are filtered with NumPy straight from the
+        array, which is not copied if it is contiguous uint8 or big
+        endian uint16 data. With shrink, palette='auto' or fewer than
+        8 bits per sample, the rows are written as buffer objects.
+        """
+        if numpy is None:
+            raise Error("write_ndarray() needs NumPy")
+        planes = self.psize // self.bytes_per_sample
+        if pixels.shape[:2] != (self.height, self.width) or \
+           pixels.size != self.height * self.width * planes:
+            raise ValueError("expected an array of shape (%d, %d, %d)"
+                             % (self.height, self.width, planes))
+        if self.bytes_per_sample == 2:
+            # http://www.w3.org/TR/PNG/#7Integers-and-byte-order
+            pixels = numpy.ascontiguousarray(pixels, '>u2')
+        else:
+            pixels = numpy.ascontiguousarray(pixels, numpy.uint8)
+        rows = pixels.view(numpy.uint8).reshape(self.height, -1)
+        if self.interlaced:
+            scanlines = self.array_scanlines_interlace(buffer(rows))
+        elif self.shrink or self.palette == 'auto' or \
+             self.bits_per_sample < 8:
+            scanlines = self.buffer_scanlines(rows)
+        else:
+            self.write_pieces(outfile, self.encode_chunks(
+                self.deflate_lines(self.ndarray_lines(rows))))
+            return
+        self.write(outfile, scanlines)
+
+    def ndarray_lines(self, rows):
+        """
+        Generator for the (filter_type, line) pairs of filtered_lines()
+        from the rows of a two-dimensional NumPy array of bytes, with
+        the filters applied by NumPy. The lines are buffer objects.
+        """
+        prev = numpy.zeros(rows.shape[1], numpy.uint8)
+        for row in rows:
+            filter_type, best = _choose_ndarray(self.filter_type, row, prev,
+                                                self.psize)
+            yield filter_type, buffer(best)
+            prev = row
+
+    def map_pixels(self, infile, size):
+        """
+        Map size bytes of pixel data, starting at the current position
+        of infile, into memory. Return a read-only buffer object, or
+        None if infile is not a regular file (e.g. a pipe).
+
+        The operating system reads the data on demand, so the pixels
+        can be served as buffer slices without copying them into
+        Python memory.
+        """
+        try:
+            offset = infile.tell()
+            mapping = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+        if len(mapping) < offset + size:
+            raise EOFError("not enough pixel data in input file")
+        return buffer(mapping, offset, size)
+
     def convert_ppm(self, ppmfile, outfile):
         """
         Convert a PPM file containing raw pixel data into a PNG file
         with the parameters set in the writer object.
         """
-        if self.interlaced:
-            pixels = array('B')
-            pixels.fromfile(ppmfile,
-                            self.bytes_per_sample * self.color_depth *
-                            self.width * self.height)
+        size = (self.bytes_per_sample * self.color_depth *
+                self.width * self.height)
+        pixels = self.map_pixels(ppmfile, size)
+        if pixels is None:
+            self.write_rows(outfile, self.file_scanlines(ppmfile))
+        elif self.interlaced:
             self.write(outfile, self.array_scanlines_interlace(pixels))
         else:
-            self.write(outfile, self.file_scanlines(ppmfile))
+            self.write(outfile, self.buffer_scanlines(pixels))
 
     def convert_ppm_and_pgm(self, ppmfile, pgmfile, outfile):
         """
         Convert a PPM and PGM file containing raw pixel data into a
         PNG outfile with the parameters set in the writer object.
         """
-        pixels = array('B')
-        pixels.fromfile(ppmfile,
-                        self.bytes_per_sample * self.color_depth *
-                        self.width * self.height)
-        apixels = array('B')
-        apixels.fromfile(pgmfile,
-                         self.bytes_per_sample *
-                         self.width * self.height)
-        pixels = interleave_planes(pixels, apixels,
-                                   self.bytes_per_sample * self.color_depth,
-                                   self.bytes_per_sample)
-        if self.interlaced:
-            self.write(outfile, self.array_scanlines_interlace(pixels))
-        else:
-            self.write(outfile, self.array_scanlines(pixels))
+        self.write_planes(outfile, [ppmfile, pgmfile], [self.color_depth, 1])
+
+    def write_planes(self, outfile, planes, samples=None):
+        """
+        Encode separate image planes to PNG and write output file.
+
+        Each item in planes is the source for one or more samples of
+        every pixel, in PNG order (e.g. R, G, B and A, or RGB and A).
+        A source can be an array, string or buffer with the whole
+        plane, a file positioned at the start of the pixel data, or an
+        iterable of rows. The samples argument gives the number of
+        samples per pixel in each source, one for each by default.
 
-    def file_scanlines(self, infile):
+        The planes are interleaved one row at a time, right before
+        filtering, so no image-sized buffer is needed.
+        """
+        self.write_rows(outfile, self.planar_scanlines(planes, samples))
+
+    def planar_scanlines(self, planes, samples=None):
+        """
+        Generator for scanlines interleaved from separate planes, see
+        write_planes for the arguments.
+        """
+        if samples is None:
+            samples = [1] * len(planes)
+        if len(samples) != len(planes):
+            raise ValueError("need a sample count for each plane")
+        if sum(samples) * self.bytes_per_sample != self.psize:
+            raise ValueError("planes do not match the colour type")
+        sources = []
+        offset = 0
+        for plane, count in zip(planes, samples):
+            size = count * self.bytes_per_sample
+            sources.append((self.plane_rows(plane, size * self.width),
+                            offset, size))
+            offset += size
+        row_bytes = self.width * self.psize
+        for y in range(self.height):
+            scanline = array('B', [0]) * row_bytes
+            for rows, offset, size in sources:
+                try:
+                    row = _as_array(_sample_bytes(rows.next()))
+                except StopIteration:
+                    raise ValueError("plane has fewer than %d rows"
+                                     % self.height)
+                if len(row) != size * self.width:
+                    raise ValueError("plane row has %d bytes instead of %d"
+                                     % (len(row), size * self.width))
+                for i in range(size):
+                    scanline[offset+i:row_bytes:self.psize] = row[i::size]
+            yield scanline
+
+    def plane_rows(self, plane, row_bytes):
+        """
+        Return an iterator for the rows of one plane source.
+        """
+        plane = _sample_bytes(plane)
+        if isinstance(plane, (array, str, buffer)):
+            return self.buffer_scanlines(plane, row_bytes)
+        if hasattr(plane, 'read'):
+            pixels = self.map_pixels(plane, row_bytes * self.height)
+            if pixels is not None:
+                return self.buffer_scanlines(pixels, row_bytes)
+            if isinstance(plane, file):
+                return self.file_scanlines(plane, row_bytes)
+            return (plane.read(row_bytes) for y in range(self.height))
+        return iter(plane)
+
+    def file_scanlines(self, infile, row_bytes=None):
         """
         Generator for scanlines from an input file.
         """
-        row_bytes = self.psize * self.width
+        if row_bytes is None:
+            row_bytes = self.psize * self.width
         for y in range(self.height):
             scanline = array('B')
             scanline.fromfile(infile, row_bytes)
@@ -346,6 +1998,16 @@ class Writer:
             stop = start + row_bytes
             yield pixels[start:stop]
 
+    def buffer_scanlines(self, pixels, row_bytes=None):
+        """
+        Generator for scanlines from a buffer or memory mapped file,
+        without copying. The scanlines are buffer objects.
+        """
+        if row_bytes is None:
+            row_bytes = self.width * self.psize
+        for y in range(self.height):
+            yield buffer(pixels, y * row_bytes, row_bytes)
+
     def old_array_scanlines_interlace(self, pixels):
         """
         Generator for interlaced scanlines from an array.
@@ -369,48 +2031,96 @@ class Writer:
 
     def array_scanlines_interlace(self, pixels):
         """
-        Generator for interlaced scanlines from an array.
+        Generator for interlaced scanlines from an array, or from a
+        buffer such as the one returned by map_pixels.
         http://www.w3.org/TR/PNG/#8InterlaceMethods
         """
         row_bytes = self.psize * self.width
+        is_buffer = isinstance(pixels, buffer)
         for xstart, ystart, xstep, ystep in _adam7:
             for y in range(ystart, self.height, ystep):
                 if xstart >= self.width:
                     continue
                 if xstep == 1:
                     offset = y * row_bytes
-                    yield pixels[offset:offset+row_bytes]
+                    if is_buffer:
+                        yield buffer(pixels, offset, row_bytes)
+                    else:
+                        yield pixels[offset:offset+row_bytes]
                 else:
-                    row = array('B')
                     # Note we want the ceiling of (self.width - xstart) / xtep
                     row_len = self.psize * (
                         (self.width - xstart + xstep - 1) / xstep)
-                    # There's no easier way to set the length of an array
-                    row.extend(pixels[0:row_len])
+                    row = array('B', [0]) * row_len
                     offset = y * row_bytes + xstart * self.psize
                     end_offset = (y+1) * row_bytes
                     skip = self.psize * xstep
                     for i in range(self.psize):
                         row[i:row_len:self.psize] = \
-                            pixels[offset+i:end_offset:skip]
+                            _as_array(pixels[offset+i:end_offset:skip])
                     yield row
 
 
+class _pieces:
+    """
+    A file-like object that collects the data written to it.
+    """
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(data)
+
+    def take(self):
+        """
+        Return the data written since the last call, as one string.
+        """
+        data = ''.join(self.pieces)
+        self.pieces = []
+        return data
+
+
 class _readable:
     """
-    A simple file-like interface for strings and arrays.
+    A file-like interface for data in memory: a string, bytearray,
+    array, buffer, memoryview or memory mapped file.
     """
 
-    def __init__(self, buf):
-        self.buf = buf
+    def __init__(self, data):
+        if isinstance(data, memoryview):
+            # Python 2 cannot make a buffer object of a memoryview,
+            # nor pass one to zlib, so this is the only copy.
+            data = data.tobytes()
+        self.data = buffer(data)
         self.offset = 0
 
-    def read(self, n):
-        r = buf[offset:offset+n]
-        if isinstance(r, array):
-            r = r.tostring()
-        offset += n
-        return r
+    def read(self, n=-1):
+        """
+        Return the next n bytes, or the rest, as a string.
+        """
+        return str(self.read_buffer(n))
+
+    def read_buffer(self, n=-1):
+        """
+        Return the next n bytes, or the rest, as a buffer object that
+        refers to the data without copying it.
+        """
+        if n < 0:
+            n = len(self.data)
+        result = buffer(self.data, self.offset, n)
+        self.offset += len(result)
+        return result
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += len(self.data)
+        self.offset = min(max(offset, 0), len(self.data))
+
+    def tell(self):
+        return self.offset
 
 
 class Reader:
@@ -427,19 +2137,38 @@ class Reader:
         type. You can choose among the following arguments:
         filename - name of PNG input file
         file - object with a read() method
-        pixels - array or string with PNG data
-
+        pixels - PNG data in memory (see below)
+
+        The optional validate argument selects which chunk checksums
+        are verified: 'strict' verifies all of them (the default),
+        'critical' only those of IHDR, PLTE, IDAT and IEND, and 'none'
+        skips the verification for trusted input. The optional stats
+        argument is a Stats object that collects time and counters.
+
+        The pixels argument is a string, bytearray, array, buffer,
+        memoryview or memory mapped file with the whole PNG file. The
+        image data is then decompressed straight from it, without
+        copying it into strings first (a memoryview is copied once).
+        A positional argument is taken as a file name if it is a
+        string, as pixels if it is one of the other types, and as a
+        file otherwise.
         """
+        self.stats = kw.pop('stats', None)
+        validate = kw.pop('validate', 'strict')
+        if validate not in ('strict', 'critical', 'none'):
+            raise ValueError("validate must be 'strict', 'critical' or 'none'")
+        self.validate = validate
         if ((_guess is not None and len(kw) != 0) or
             (_guess is None and len(kw) != 1)):
             raise TypeError("Reader() takes exactly 1 argument")
 
         if _guess is not None:
-            if isinstance(_guess, array):
+            if isinstance(_guess, (array, bytearray, buffer, memoryview,
+                                   mmap.mmap)):
                 kw["pixels"] = _guess
-            elif isinstance(_guess, str):
+            elif isinstance(_guess, basestring):
                 kw["filename"] = _guess
-            elif isinstance(_guess, file):
+            else:
                 kw["file"] = _guess
 
         if "filename" in kw:
@@ -455,171 +2184,100 @@ class Reader:
         """
         Read a PNG chunk from the input file, return tag name and data.
         """
+        data_bytes, tag = self.read_chunk_header()
+        return tag, self.read_chunk_data(tag, data_bytes)
+
+    def read_chunk_header(self):
+        """
+        Read the length and tag of the next PNG chunk.
+        """
         # http://www.w3.org/TR/PNG/#5Chunk-layout
         try:
-            data_bytes, tag = struct.unpack('!I4s', self.file.read(8))
+            return struct.unpack('!I4s', self.file.read(8))
         except struct.error:
-            raise ValueError('Chunk too short for header')
-        data = self.file.read(data_bytes)
+            raise FormatError('Chunk too short for header')
+
+    def read_chunk_data(self, tag, data_bytes):
+        """
+        Read the data and checksum of a chunk after its header, verify
+        the checksum as selected by the validate argument of Reader(),
+        and return the data.
+
+        The image data of PNG data in memory is returned as a buffer
+        object without copying it.
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        if tag == 'IDAT' and isinstance(self.file, _readable):
+            data = self.file.read_buffer(data_bytes)
+        else:
+            data = self.file.read(data_bytes)
         if len(data) != data_bytes:
-            raise ValueError('Chunk %s too short for required %i data octets'
-                             % (tag, data_bytes))
+            raise FormatError('Chunk %s too short for required %i data'
+                              ' octets' % (tag, data_bytes))
         checksum = self.file.read(4)
         if len(checksum) != 4:
-            raise ValueError('Chunk %s too short for checksum', tag)
-        verify = zlib.crc32(tag)
-        verify = zlib.crc32(data, verify)
-        verify = struct.pack('!i', verify)
+            raise FormatError('Chunk %s too short for checksum' % tag)
+        if stats is None:
+            self.verify_chunk(tag, data, checksum)
+        else:
+            stats.add('input', time.time() - start)
+            stats.call('crc', self.verify_chunk, tag, data, checksum)
+        return data
+
+    def verify_chunk(self, tag, data, checksum):
+        """
+        Verify the checksum of a chunk as selected by the validate
+        argument of Reader(), raise ValueError if it is wrong.
+        """
+        if self.validate == 'none':
+            return
+        # Ancillary chunks have a lower case first letter.
+        # http://www.w3.org/TR/PNG/#5Chunk-naming-conventions
+        if self.validate == 'critical' and tag[0].islower():
+            return
+        (checksum, ) = struct.unpack('!I', checksum)
+        verify = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
         if checksum != verify:
-            # print repr(checksum)
-            (a, ) = struct.unpack('!I', checksum)
-            (b, ) = struct.unpack('!I', verify)
             raise ValueError("Checksum error in %s chunk: 0x%X != 0x%X"
-                             % (tag, a, b))
-        return tag, data
-
-    def _reconstruct_sub(self, offset, xstep, ystep):
-        """
-        Reverse sub filter.
-        """
-        pixels = self.pixels
-        a_offset = offset
-        offset += self.psize * xstep
-        if xstep == 1:
-            for index in range(self.psize, self.row_bytes):
-                x = pixels[offset]
-                a = pixels[a_offset]
-                pixels[offset] = (x + a) & 0xff
-                offset += 1
-                a_offset += 1
-        else:
-            byte_step = self.psize * xstep
-            for index in range(byte_step, self.row_bytes, byte_step):
-                for i in range(self.psize):
-                    x = pixels[offset + i]
-                    a = pixels[a_offset + i]
-                    pixels[offset + i] = (x + a) & 0xff
-                offset += self.psize * xstep
-                a_offset += self.psize * xstep
-
-    def _reconstruct_up(self, offset, xstep, ystep):
-        """
-        Reverse up filter.
-        """
-        pixels = self.pixels
-        b_offset = offset - (self.row_bytes * ystep)
-        if xstep == 1:
-            for index in range(self.row_bytes):
-                x = pixels[offset]
-                b = pixels[b_offset]
-                pixels[offset] = (x + b) & 0xff
-                offset += 1
-                b_offset += 1
-        else:
-            for index in range(0, self.row_bytes, xstep * self.psize):
-                for i in range(self.psize):
-                    x = pixels[offset + i]
-                    b = pixels[b_offset + i]
-                    pixels[offset + i] = (x + b) & 0xff
-                offset += self.psize * xstep
-                b_offset += self.psize * xstep
-
-    def _reconstruct_average(self, offset, xstep, ystep):
-        """
-        Reverse average filter.
-        """
-        pixels = self.pixels
-        a_offset = offset - (self.psize * xstep)
-        b_offset = offset - (self.row_bytes * ystep)
-        if xstep == 1:
-            for index in range(self.row_bytes):
-                x = pixels[offset]
-                if index < self.psize:
-                    a = 0
-                else:
-                    a = pixels[a_offset]
-                if b_offset < 0:
-                    b = 0
-                else:
-                    b = pixels[b_offset]
-                pixels[offset] = (x + ((a + b) >> 1)) & 0xff
-                offset += 1
-                a_offset += 1
-                b_offset += 1
-        else:
-            for index in range(0, self.row_bytes, self.psize * xstep):
-                for i in range(self.psize):
-                    x = pixels[offset+i]
-                    if index < self.psize:
-                        a = 0
-                    else:
-                        a = pixels[a_offset + i]
-                    if b_offset < 0:
-                        b = 0
-                    else:
-                        b = pixels[b_offset + i]
-                    pixels[offset + i] = (x + ((a + b) >> 1)) & 0xff
-                offset += self.psize * xstep
-                a_offset += self.psize * xstep
-                b_offset += self.psize * xstep
-
-    def _reconstruct_paeth(self, offset, xstep, ystep):
-        """
-        Reverse Paeth filter.
-        """
-        pixels = self.pixels
-        a_offset = offset - (self.psize * xstep)
-        b_offset = offset - (self.row_bytes * ystep)
-        c_offset = b_offset - (self.psize * xstep)
-        # There's enough inside this loop that it's probably not worth
-        # optimising for xstep == 1
-        for index in range(0, self.row_bytes, self.psize * xstep):
-            for i in range(self.psize):
-                x = pixels[offset+i]
-                if index < self.psize:
-                    a = c = 0
-                    b = pixels[b_offset+i]
-                else:
-                    a = pixels[a_offset+i]
-                    b = pixels[b_offset+i]
-                    c = pixels[c_offset+i]
-                p = a + b - c
-                pa = abs(p - a)
-                pb = abs(p - b)
-                pc = abs(p - c)
-                if pa <= pb and pa <= pc:
-                    pr = a
-                elif pb <= pc:
-                    pr = b
-                else:
-                    pr = c
-                pixels[offset+i] = (x + pr) & 0xff
-            offset += self.psize * xstep
-            a_offset += self.psize * xstep
-            b_offset += self.psize * xstep
-            c_offset += self.psize * xstep
-
-    # N.B. PNG files with 'up', 'average' or 'paeth' filters on the
-    # first line of a pass are legal. The code above for 'average'
-    # deals with this case explicitly. For up we map to the null
-    # filter and for paeth we map to the sub filter.
-
-    def reconstruct_line(self, filter_type, first_line, offset, xstep, ystep):
-        """
-        Reverse the filtering for a scanline.
-        """
-        # print >> sys.stderr, "Filter type %s, first_line=%s" % (
-        #                      filter_type, first_line)
-        filter_type += (first_line << 8)
-        if filter_type == 1 or filter_type == 0x101 or filter_type == 0x104:
-            self._reconstruct_sub(offset, xstep, ystep)
-        elif filter_type == 2:
-            self._reconstruct_up(offset, xstep, ystep)
-        elif filter_type == 3 or filter_type == 0x103:
-            self._reconstruct_average(offset, xstep, ystep)
-        elif filter_type == 4:
-            self._reconstruct_paeth(offset, xstep, ystep)
-        return
+                             % (tag, checksum, verify))
+
+    def skip_chunk_data(self, data_bytes):
+        """
+        Skip the data and checksum of a chunk after its header, with
+        seek() if the input file supports it.
+        """
+        try:
+            self.file.seek(data_bytes + 4, 1)
+            return
+        except (AttributeError, IOError):
+            pass
+        remaining = data_bytes + 4
+        while remaining > 0:
+            skipped = len(self.file.read(min(remaining, 2**16)))
+            if not skipped:
+                raise FormatError('Chunk too short for data and checksum')
+            remaining -= skipped
+
+    def undo_filter(self, filter_type, scanline, previous):
+        """
+        Reverse the filtering for a scanline, return the unfiltered
+        scanline as an array.
+
+        The previous argument is the unfiltered previous scanline of
+        the same pass, or None for the first scanline. The work is done
+        by the implementation selected with png.unfilter_backend.
+        """
+        if self.stats is not None:
+            if filter_type < len(self.stats.filter_types):
+                self.stats.filter_types[filter_type] += 1
+            return self.stats.call('unfilter',
+                                   _unfilter_backends[unfilter_backend],
+                                   filter_type, scanline, previous,
+                                   self.psize)
+        return _unfilter_backends[unfilter_backend](
+            filter_type, scanline, previous, self.psize)
 
     def deinterlace(self, scanlines):
         """
@@ -627,286 +2285,1440 @@ class Reader:
         """
         # print >> sys.stderr, ("Reading interlaced, w=%s, r=%s, planes=%s," +
         #     " bpp=%s") % (self.width, self.height, self.planes, self.bps)
-        a = array('B')
+        a = array('B', [0]) * (self.row_bytes * self.height)
         self.pixels = a
-        # Make the array big enough
-        temp = scanlines[0:self.width*self.height*self.psize]
-        a.extend(temp)
         source_offset = 0
         for xstart, ystart, xstep, ystep in _adam7:
             # print >> sys.stderr, "Adam7: start=%s,%s step=%s,%s" % (
             #     xstart, ystart, xstep, ystep)
-            filter_first_line = 1
+            if xstart >= self.width:
+                continue
+            # Note we want the ceiling of (width - xstart) / xtep
+            pixels = (self.width - xstart + xstep - 1) / xstep
+            row_len = self.scanline_length(pixels)
+            skip = self.psize * xstep
+            previous = None
             for y in range(ystart, self.height, ystep):
-                if xstart >= self.width:
-                    continue
                 filter_type = scanlines[source_offset]
                 source_offset += 1
+                line = self.undo_filter(filter_type,
+                    scanlines[source_offset:source_offset + row_len],
+                    previous)
+                source_offset += row_len
+                previous = line
+                if self.bits_per_sample < 8:
+                    line = _unpack_bits(line, self.bits_per_sample, pixels)
+                offset = y * self.row_bytes + xstart * self.psize
                 if xstep == 1:
-                    offset = y * self.row_bytes
-                    a[offset:offset+self.row_bytes] = \
-                        scanlines[source_offset:source_offset + self.row_bytes]
-                    source_offset += self.row_bytes
+                    a[offset:offset+len(line)] = line
                 else:
-                    # Note we want the ceiling of (width - xstart) / xtep
-                    row_len = self.psize * (
-                        (self.width - xstart + xstep - 1) / xstep)
-                    offset = y * self.row_bytes + xstart * self.psize
                     end_offset = (y+1) * self.row_bytes
-                    skip = self.psize * xstep
                     for i in range(self.psize):
-                        a[offset+i:end_offset:skip] = \
-                            scanlines[source_offset + i:
-                                      source_offset + row_len:
-                                      self.psize]
-                    source_offset += row_len
-                if filter_type:
-                    self.reconstruct_line(filter_type, filter_first_line,
-                                          offset, xstep, ystep)
-                filter_first_line = 0
+                        a[offset+i:end_offset:skip] = line[i::self.psize]
         return a
 
-    def read_flat(self, scanlines):
+    def process_chunk(self, tag, data):
         """
-        Read pixel data without de-interlacing.
+        Store the information from a chunk other than IDAT and IEND.
         """
-        a = array('B')
-        self.pixels = a
-        offset = 0
-        source_offset = 0
-        filter_first_line = 1
-        for y in range(self.height):
-            filter_type = scanlines[source_offset]
-            source_offset += 1
-            a.extend(scanlines[source_offset: source_offset + self.row_bytes])
-            if filter_type:
-                self.reconstruct_line(filter_type, filter_first_line,
-                                      offset, 1, 1)
-            filter_first_line = 0
-            offset += self.row_bytes
-            source_offset += self.row_bytes
-        return a
+        if tag == 'IHDR': # http://www.w3.org/TR/PNG/#11IHDR
+            (width, height, bits_per_sample, color_type,
+             compression_method, filter_method,
+             interlaced) = struct.unpack("!2I5B", data)
+            # http://www.w3.org/TR/PNG/#table111
+            if bits_per_sample not in (1, 2, 4, 8, 16):
+                raise Error("invalid pixel depth")
+            if bits_per_sample < 8 and color_type not in (0, 3):
+                raise Error("invalid pixel depth for colour type")
+            bps = max(1, bits_per_sample / 8)
+            if color_type == 0:
+                greyscale = True
+                has_alpha = False
+                planes = 1
+            elif color_type == 2:
+                greyscale = False
+                has_alpha = False
+                planes = 3
+            elif color_type == 3:
+                if bps != 1:
+                    raise Error("invalid pixel depth for palette image")
+                greyscale = False
+                has_alpha = False
+                planes = 3
+            elif color_type == 4:
+                greyscale = True
+                has_alpha = True
+                planes = 2
+            elif color_type == 6:
+                greyscale = False
+                has_alpha = True
+                planes = 4
+            else:
+                raise Error("unknown PNG colour type %s" % color_type)
+            if compression_method != 0:
+                raise Error("unknown compression method")
+            if filter_method != 0:
+                raise Error("unknown filter method")
+            self.bps = bps
+            self.bits_per_sample = bits_per_sample
+            self.planes = planes
+            self.psize = bps * planes
+            if color_type == 3:
+                # The pixels are stored as indices into the palette.
+                self.psize = bps
+            self.color_type = color_type
+            self.palette = None
+            self.width = width
+            self.height = height
+            self.row_bytes = width * self.psize
+            self.greyscale = greyscale
+            self.has_alpha = has_alpha
+            self.interlaced = interlaced
+            self.image_metadata["greyscale"] = greyscale
+            self.image_metadata["has_alpha"] = has_alpha
+            self.image_metadata["bytes_per_sample"] = bps
+            self.image_metadata["bits_per_sample"] = bits_per_sample
+            self.image_metadata["interlaced"] = interlaced
+        elif tag == 'PLTE': # http://www.w3.org/TR/PNG/#11PLTE
+            if len(data) % 3 or not 0 < len(data) <= 3 * 256:
+                raise Error("invalid PLTE chunk length %d" % len(data))
+            # A palette for a truecolour image is only a suggestion.
+            if self.color_type == 3:
+                entries = struct.unpack("%dB" % len(data), data)
+                self.palette = zip(entries[0::3], entries[1::3],
+                                   entries[2::3])
+                self.image_metadata["palette"] = self.palette
+        elif tag == 'bKGD' and self.color_type == 3:
+            self.image_metadata["background"] = \
+                self.palette[ord(data)][:3]
+        elif tag == 'tRNS' and self.color_type == 3:
+            if self.palette is None or len(data) > len(self.palette):
+                raise Error("tRNS chunk does not match the palette")
+            alphas = struct.unpack("%dB" % len(data), data)
+            alphas += (255, ) * (len(self.palette) - len(alphas))
+            self.palette = [entry + (alpha, )
+                            for entry, alpha in zip(self.palette, alphas)]
+            self.has_alpha = True
+            self.planes = 4
+            self.image_metadata["has_alpha"] = True
+            self.image_metadata["palette"] = self.palette
+        elif tag == 'bKGD':
+            if self.greyscale:
+                self.image_metadata["background"] = \
+                    struct.unpack("!1H", data)
+            else:
+                self.image_metadata["background"] = \
+                    struct.unpack("!3H", data)
+        elif tag == 'tRNS':
+            if self.greyscale:
+                self.image_metadata["transparent"] = \
+                    struct.unpack("!1H", data)
+            else:
+                self.image_metadata["transparent"] = \
+                    struct.unpack("!3H", data)
+        elif tag == 'gAMA':
+            self.image_metadata["gamma"] = (
+                struct.unpack("!L", data)[0]) / 100000.0
 
-    def read(self):
+    def _chunk(self):
         """
-        Read a simple PNG file, return width, height, pixels and image metadata
+        Read the next chunk, converting errors to png.Error.
+        """
+        try:
+            return self.read_chunk()
+        except ValueError, e:
+            raise Error('Chunk error: ' + e.args[0])
+
+    def preamble(self):
+        """
+        Read the PNG signature and all chunks up to the first IDAT
+        chunk. Afterwards, width, height and image_metadata are set.
+        """
+        self.read_signature()
+        self.image_metadata = {}
+        while True:
+            tag, data = self._chunk()
+            # print >> sys.stderr, tag, len(data)
+            if tag == 'IDAT': # http://www.w3.org/TR/PNG/#11IDAT
+                self.first_idat = data
+                break
+            if tag == 'IEND': # http://www.w3.org/TR/PNG/#11IEND
+                raise Error("PNG file has no image data")
+            self.process_chunk(tag, data)
+        self.end_preamble()
+
+    def end_preamble(self):
+        """
+        Check the chunks before the image data, when the first IDAT
+        chunk has been read.
+        """
+        if self.color_type == 3:
+            if self.palette is None:
+                raise Error("PNG file has no palette")
+            self.palette_tables = _palette_tables(self.palette)
+
+    def expand_palette(self, pixels):
+        """
+        Return the pixels of a palette image with the colours of the
+        palette entries instead of indices, RGB or RGBA if there is a
+        tRNS chunk. Other pixels are returned unchanged.
+        """
+        if self.color_type != 3:
+            return pixels
+        return _expand_indices(pixels, self.palette_tables)
+
+    def idat(self):
+        """
+        Generator for the contents of the IDAT chunks, to be called
+        after preamble(). Chunks after the image data are processed
+        until the IEND chunk.
+        """
+        data = self.first_idat
+        del self.first_idat
+        yield data
+        while True:
+            tag, data = self._chunk()
+            if tag == 'IDAT':
+                yield data
+            elif tag == 'IEND':
+                break
+            else:
+                self.process_chunk(tag, data)
 
-        This function is a very early prototype with limited flexibility
-        and excessive use of memory.
+    def read_signature(self):
         """
+        Read the PNG signature at the start of the file.
+        """
+        # http://www.w3.org/TR/PNG/#5PNG-file-signature
         signature = self.file.read(8)
         if (signature != struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10)):
             raise Error("PNG file has invalid header")
-        compressed = []
-        image_metadata = {}
+
+    def chunks(self):
+        """
+        Read the PNG signature, return a generator for all chunks as
+        (tag, data) pairs up to IEND, without looking into them. The
+        data of IDAT chunks may be a buffer object, see read_chunk_data().
+        """
+        self.read_signature()
+        return self._iter_chunks()
+
+    def _iter_chunks(self):
+        """
+        Generator for the chunks after the signature.
+        """
         while True:
-            try:
-                tag, data = self.read_chunk()
-            except ValueError, e:
-                raise Error('Chunk error: ' + e.args[0])
+            tag, data = self._chunk()
+            yield tag, data
+            if tag == 'IEND':
+                break
 
-            # print >> sys.stderr, tag, len(data)
-            if tag == 'IHDR': # http://www.w3.org/TR/PNG/#11IHDR
-                (width, height, bits_per_sample, color_type,
-                 compression_method, filter_method,
-                 interlaced) = struct.unpack("!2I5B", data)
-                bps = bits_per_sample / 8
-                if bps == 0:
-                    raise Error("unsupported pixel depth")
-                if bps > 2 or bits_per_sample != (bps * 8):
-                    raise Error("invalid pixel depth")
-                if color_type == 0:
-                    greyscale = True
-                    has_alpha = False
-                    planes = 1
-                elif color_type == 2:
-                    greyscale = False
-                    has_alpha = False
-                    planes = 3
-                elif color_type == 4:
-                    greyscale = True
-                    has_alpha = True
-                    planes = 2
-                elif color_type == 6:
-                    greyscale = False
-                    has_alpha = True
-                    planes = 4
+    def info(self):
+        """
+        Read the PNG header and walk over the remaining chunks without
+        decompressing the image, return width, height, image_metadata
+        and a list of chunks.
+
+        Each chunk is a (tag, offset, length) tuple, where offset is
+        the position of the chunk in the PNG data (the signature is at
+        offset 0) and length is the size of the chunk data. Only the
+        chunks that go into image_metadata are read and checked; the
+        others, including IDAT, are skipped with seek() when the input
+        file supports it. Nothing can be read afterwards.
+        """
+        self.read_signature()
+        self.image_metadata = {}
+        chunks = []
+        offset = 8
+        try:
+            while True:
+                data_bytes, tag = self.read_chunk_header()
+                chunks.append((tag, offset, data_bytes))
+                offset += data_bytes + 12
+                if tag in ('IHDR', 'PLTE', 'bKGD', 'tRNS', 'gAMA'):
+                    self.process_chunk(tag,
+                                       self.read_chunk_data(tag, data_bytes))
                 else:
-                    raise Error("unknown PNG colour type %s" % color_type)
-                if compression_method != 0:
-                    raise Error("unknown compression method")
-                if filter_method != 0:
-                    raise Error("unknown filter method")
-                self.bps = bps
-                self.planes = planes
-                self.psize = bps * planes
-                self.width = width
-                self.height = height
-                self.row_bytes = width * self.psize
-            elif tag == 'IDAT': # http://www.w3.org/TR/PNG/#11IDAT
-                compressed.append(data)
-            elif tag == 'bKGD':
-                if greyscale:
-                    image_metadata["background"] = struct.unpack("!1H", data)
+                    self.skip_chunk_data(data_bytes)
+                if tag == 'IEND':
+                    break
+        except ValueError, e:
+            raise Error('Chunk error: ' + e.args[0])
+        if chunks[0][0] != 'IHDR':
+            raise Error("PNG file does not start with IHDR")
+        return self.width, self.height, self.image_metadata, chunks
+
+    def iter_rows(self, samples=False):
+        """
+        Read the PNG header, return a generator for the rows of pixels.
+        With samples, the rows of 16-bit images are arrays of native
+        integers ('H') instead of big-endian pairs of bytes.
+
+        The image data is decompressed incrementally while the IDAT
+        chunks are read, and each row is unfiltered as soon as it is
+        complete. Only the previous row and the zlib state are kept,
+        so memory use does not grow with the height of the image.
+        Interlaced images are decoded in full before the first row is
+        returned, because every row depends on all seven passes.
+
+        The width, height and image_metadata attributes are available
+        as soon as this method returns.
+        """
+        self.preamble()
+        if self.interlaced:
+            rows = self._iter_deinterlaced_rows()
+        else:
+            rows = self._iter_flat_rows()
+        if self.color_type == 3:
+            return (self.expand_palette(row) for row in rows)
+        if samples and self.bps == 2:
+            return (_row_samples(row, 2) for row in rows)
+        return rows
+
+    def _read_interlaced(self):
+        """
+        Decode an interlaced image into one flat array.
+        """
+        scanlines = array('B')
+        for data in self._decompressed():
+            scanlines.fromstring(data)
+        if self.stats is not None:
+            self.stats.buffer(len(scanlines))
+        return self.deinterlace(scanlines)
+
+    def _iter_deinterlaced_rows(self):
+        """
+        Generator for rows from an interlaced image.
+        """
+        pixels = self._read_interlaced()
+        for y in range(self.height):
+            yield pixels[y * self.row_bytes:(y + 1) * self.row_bytes]
+
+    def _decompressed(self):
+        """
+        Generator for the decompressed image data in pieces of bounded
+        size, to be called after preamble().
+        """
+        limit = max(self.row_bytes + 1, 2**16)
+        decompressor = zlib.decompressobj()
+        decompress = decompressor.decompress
+        stats = self.stats
+        for data in self.idat():
+            if stats is not None:
+                stats.idat_chunks += 1
+                stats.zlib_in += len(data)
+            # The chunk goes in as buffer slices, so that the copies
+            # in unconsumed_tail stay small.
+            for start in range(0, len(data), 2**16):
+                piece = buffer(data, start, 2**16)
+                while piece:
+                    if stats is None:
+                        yield decompress(piece, limit)
+                    else:
+                        result = stats.call('inflate', decompress, piece,
+                                            limit)
+                        stats.zlib_out += len(result)
+                        yield result
+                    piece = decompressor.unconsumed_tail
+        result = decompressor.flush()
+        if stats is not None:
+            stats.zlib_out += len(result)
+        yield result
+
+    def _raw_scanlines(self, lengths):
+        """
+        Generator for (filter type, filtered scanline) pairs, one for
+        each of the given scanline lengths. The image data is only
+        decompressed as far as needed for the scanlines requested.
+        """
+        pieces = self._decompressed()
+        pending = ''
+        start = 0
+        for count, length in enumerate(lengths):
+            while len(pending) - start <= length:
+                pending = pending[start:]
+                start = 0
+                try:
+                    pending += pieces.next()
+                    if self.stats is not None:
+                        self.stats.buffer(len(pending))
+                except StopIteration:
+                    raise Error("image data is too short: %d of %d scanlines"
+                                % (count, len(lengths)))
+            filter_type = ord(pending[start])
+            line = array('B', pending[start + 1:start + 1 + length])
+            start += 1 + length
+            yield filter_type, line
+        # Read the remaining chunks up to IEND.
+        for piece in pieces:
+            pass
+
+    def scanline_length(self, pixels):
+        """
+        Return the number of bytes of a scanline with the given number
+        of pixels, as stored in the image data without filter type.
+        """
+        # http://www.w3.org/TR/PNG/#7Scanline
+        if self.bits_per_sample < 8:
+            return (pixels * self.bits_per_sample + 7) // 8
+        return pixels * self.psize
+
+    def _iter_flat_rows(self):
+        """
+        Generator for rows from a non-interlaced image.
+        """
+        previous = None
+        for filter_type, row in self._raw_scanlines(
+                [self.scanline_length(self.width)] * self.height):
+            row = self.undo_filter(filter_type, row, previous)
+            previous = row
+            if self.bits_per_sample < 8:
+                yield _unpack_bits(row, self.bits_per_sample, self.width)
+            else:
+                yield row[:]
+
+    def _iter_pass_lines(self):
+        """
+        Generator for the unfiltered scanlines of an interlaced image,
+        as (pass index, y, scanline, last scanline of pass) tuples.
+        """
+        layout = []
+        for index, (xstart, ystart, xstep, ystep) in enumerate(_adam7):
+            if xstart >= self.width:
+                continue
+            # Note we want the ceiling of (width - xstart) / xtep
+            pixels = (self.width - xstart + xstep - 1) / xstep
+            rows = range(ystart, self.height, ystep)
+            for y in rows:
+                layout.append((index, y, pixels, y == rows[-1]))
+        scanlines = self._raw_scanlines(
+            [self.scanline_length(pixels)
+             for index, y, pixels, last in layout])
+        previous = None
+        for index, y, pixels, last in layout:
+            filter_type, line = scanlines.next()
+            line = self.undo_filter(filter_type, line, previous)
+            previous = line
+            if last:
+                previous = None
+            if self.bits_per_sample < 8:
+                line = _unpack_bits(line, self.bits_per_sample, pixels)
+            yield index, y, line, last
+
+    def _replicate_line(self, pixels, index, y, line):
+        """
+        Copy a scanline from Adam7 pass index into a full-size image,
+        filling the rectangle that each pixel stands for until the
+        later passes are decoded.
+        """
+        xstart, ystart, xstep, ystep = _adam7[index]
+        # The rectangles are 8x8 for the first pass, then 4x8, 4x4,
+        # 2x4, 2x2, 1x2 and 1x1.
+        block_width = xstart or xstep
+        block_height = ystart or ystep
+        row_start = y * self.row_bytes
+        row_end = row_start + self.row_bytes
+        skip = self.psize * xstep
+        for x in range(xstart, min(xstart + block_width, self.width)):
+            count = len(range(x, self.width, xstep))
+            for i in range(self.psize):
+                pixels[row_start + x * self.psize + i:row_end:skip] = \
+                    line[i::self.psize][:count]
+        for below in range(y + 1, min(y + block_height, self.height)):
+            pixels[below * self.row_bytes:(below + 1) * self.row_bytes] = \
+                pixels[row_start:row_end]
+
+    def iter_passes(self):
+        """
+        Read the PNG header of an interlaced image, return a generator
+        that yields a (pass number, pixels) pair after each Adam7 pass.
+
+        The pixels are a full-size preview, in which every pixel
+        decoded so far fills the rectangle up to the pixels of later
+        passes. The same array is updated by each pass (except for
+        palette images), and holds the complete image after pass 7.
+        Passes that have no pixels in a very small image are skipped.
+        """
+        self.preamble()
+        if not self.interlaced:
+            raise Error("image is not interlaced")
+        return self._iter_passes()
+
+    def _iter_passes(self):
+        """
+        Generator for the full-size preview after each Adam7 pass.
+        """
+        pixels = array('B', [0]) * (self.row_bytes * self.height)
+        for index, y, line, last in self._iter_pass_lines():
+            self._replicate_line(pixels, index, y, line)
+            if last:
+                yield index + 1, self.expand_palette(pixels)
+
+    def read_passes(self, count, preview=False):
+        """
+        Read an interlaced PNG file up to Adam7 pass count (1-7),
+        return width, height, pixels and image metadata.
+
+        Decompression stops as soon as the pass is complete, so the
+        first pass costs about 1/64 of a full decode. The pixels are
+        the reduced image formed by passes 1 to count, which has 1/8,
+        1/4, 1/2 or all of the columns and rows of the full image,
+        depending on the pass. With preview, the pixels are a
+        full-size image with each decoded pixel repeated over its
+        rectangle instead.
+        """
+        if count < 1 or count > 7:
+            raise ValueError("pass count must be 1 to 7")
+        self.preamble()
+        if not self.interlaced:
+            raise Error("image is not interlaced")
+        # The reduced image keeps every column_step-th column and every
+        # row_step-th row, the pixel size of the preview rectangles.
+        xstart, ystart, xstep, ystep = _adam7[count - 1]
+        column_step = xstart or xstep
+        row_step = ystart or ystep
+        if preview:
+            width = self.width
+            height = self.height
+        else:
+            width = (self.width + column_step - 1) // column_step
+            height = (self.height + row_step - 1) // row_step
+        row_bytes = width * self.psize
+        pixels = array('B', [0]) * (row_bytes * height)
+        for index, y, line, last in self._iter_pass_lines():
+            if index >= count:
+                break
+            if preview:
+                self._replicate_line(pixels, index, y, line)
+            else:
+                xstart, ystart, xstep, ystep = _adam7[index]
+                offset = (y // row_step) * row_bytes + \
+                         (xstart // column_step) * self.psize
+                skip = (xstep // column_step) * self.psize
+                row_end = (y // row_step + 1) * row_bytes
+                for i in range(self.psize):
+                    pixels[offset + i:row_end:skip] = line[i::self.psize]
+            if last and index == count - 1:
+                break
+        pixels = self.expand_palette(pixels)
+        return width, height, pixels, self.image_metadata
+
+    def read(self, samples=False):
+        """
+        Read a simple PNG file, return width, height, pixels and image metadata
+
+        The pixels are returned as one flat array. Use iter_rows()
+        instead to process large images one row at a time. With
+        samples, the pixels of 16-bit images are an array of native
+        integers ('H') instead of big-endian pairs of bytes.
+        """
+        self.preamble()
+        pixels = self._read_pixels()
+        if samples:
+            pixels = _row_samples(pixels, self.bps)
+        return self.width, self.height, pixels, self.image_metadata
+
+    def _read_pixels(self):
+        """
+        Decode the image data into one flat array, after preamble().
+        """
+        if self.interlaced:
+            pixels = self._read_interlaced()
+        else:
+            pixels = array('B')
+            for row in self._iter_flat_rows():
+                pixels.extend(row)
+        return self.expand_palette(pixels)
+
+    def read_ndarray(self):
+        """
+        Read a PNG file into a NumPy array, return width, height,
+        pixels and image metadata.
+
+        The pixels are an array of shape (height, width, planes), with
+        the dtype uint8, or uint16 in native byte order for 16-bit
+        images. The scanlines of a non-interlaced image with 8 or 16
+        bits per sample are unfiltered straight into the array, and
+        16-bit samples are swapped in place, so the image is never
+        copied as a whole.
+        """
+        if numpy is None:
+            raise Error("read_ndarray() needs NumPy")
+        self.preamble()
+        if self.interlaced or self.bits_per_sample < 8:
+            pixels = numpy.frombuffer(self._read_pixels(), numpy.uint8)
+        else:
+            row_bytes = self.scanline_length(self.width)
+            pixels = numpy.empty((self.height, row_bytes), numpy.uint8)
+            previous = None
+            for y, (filter_type, line) in enumerate(self._raw_scanlines(
+                    [row_bytes] * self.height)):
+                _unfilter_ndarray(filter_type, line, previous, self.psize,
+                                  pixels[y])
+                previous = pixels[y]
+            if self.color_type == 3:
+                table = numpy.zeros((256, self.planes), numpy.uint8)
+                table[:len(self.palette)] = self.palette
+                pixels = table[pixels]
+        if self.image_metadata['bytes_per_sample'] == 2:
+            pixels = pixels.view(numpy.uint16)
+            if sys.byteorder == 'little':
+                pixels.byteswap(True)
+        return (self.width, self.height,
+                pixels.reshape(self.height, self.width, self.planes),
+                self.image_metadata)
+
+    def read_scaled(self, factor=None, size=None):
+        """
+        Read a PNG file and reduce it in size while decoding, return
+        width, height, pixels and image metadata of the smaller image.
+
+        Give either an integer factor, to average boxes of factor x
+        factor pixels (smaller at the right and bottom edges), or the
+        size of the result as a (width, height) tuple, to average boxes
+        of about width/size pixels. The pixels have the same format
+        as from read().
+
+        The rows are summed up as they are decoded, so the full
+        resolution image is never stored, except that an interlaced
+        image has to be decoded in full first. With an alpha channel,
+        the colours are weighted by alpha, so that fully transparent
+        pixels do not change the colour of the result. Whole rows are
+        summed with NumPy if it is available, and the averages are
+        only divided out once for each row of the result.
+        """
+        if (factor is None) == (size is None):
+            raise TypeError("read_scaled() needs a factor or a size")
+        rows = self.iter_rows()
+        if factor is not None:
+            if factor < 1:
+                raise ValueError("factor must be at least 1")
+            xedges = range(0, self.width, factor) + [self.width]
+            yedges = range(0, self.height, factor) + [self.height]
+        else:
+            width, height = size
+            if not (0 < width <= self.width and 0 < height <= self.height):
+                raise ValueError("size must be between 1x1 and %dx%d"
+                                 % (self.width, self.height))
+            xedges = [x * self.width // width for x in range(width + 1)]
+            yedges = [y * self.height // height for y in range(height + 1)]
+        planes = self.planes
+        colours = planes - self.has_alpha
+        out = []
+        for top, bottom in zip(yedges[:-1], yedges[1:]):
+            total = self._sum_rows(rows, bottom - top)
+            if numpy is not None:
+                sums = numpy.add.reduceat(total.reshape(-1, planes),
+                                          xedges[:-1], axis=0)
+                count = numpy.diff(xedges).reshape(-1, 1) * (bottom - top)
+                if self.has_alpha:
+                    weight = sums[:, -1:]
+                    result = numpy.where(
+                        weight > 0,
+                        (sums[:, :colours] + weight // 2) //
+                        numpy.maximum(weight, 1), 0)
+                    result = numpy.hstack(
+                        (result, (weight + count // 2) // count))
                 else:
-                    image_metadata["background"] = struct.unpack("!3H", data)
-            elif tag == 'tRNS':
-                if greyscale:
-                    image_metadata["transparent"] = struct.unpack("!1H", data)
+                    result = (sums + count // 2) // count
+                out.extend(result.ravel().tolist())
+                continue
+            for left, right in zip(xedges[:-1], xedges[1:]):
+                count = (right - left) * (bottom - top)
+                sums = [sum(total[left * planes + i:right * planes:planes])
+                        for i in range(planes)]
+                if self.has_alpha:
+                    weight = sums[-1]
+                    for i in range(colours):
+                        if weight:
+                            out.append((sums[i] + weight // 2) // weight)
+                        else:
+                            out.append(0)
+                    out.append((weight + count // 2) // count)
                 else:
-                    image_metadata["transparent"] = struct.unpack("!3H", data)
-            elif tag == 'gAMA':
-                image_metadata["gamma"] = (
-                    struct.unpack("!L", data)[0]) / 100000.0
-            elif tag == 'IEND': # http://www.w3.org/TR/PNG/#11IEND
+                    for i in range(planes):
+                        out.append((sums[i] + count // 2) // count)
+        # Read the remaining chunks up to IEND.
+        for row in rows:
+            pass
+        return (len(xedges) - 1, len(yedges) - 1,
+                _samples_to_bytes(out, self.bps), self.image_metadata)
+
+    def _sum_rows(self, rows, count):
+        """
+        Take count rows from the iterator rows and return the sum of
+        each sample over them, with the colours weighted by alpha, for
+        read_scaled(). The sums are a NumPy array if NumPy is
+        available, otherwise a tuple.
+        """
+        planes = self.planes
+        colours = planes - self.has_alpha
+        if numpy is not None:
+            total = numpy.zeros(self.width * planes, numpy.int64)
+            dtype = self.bps == 2 and '>u2' or numpy.uint8
+            for y in range(count):
+                samples = numpy.frombuffer(rows.next(), dtype).astype(
+                    numpy.int64)
+                if self.has_alpha:
+                    pixels = samples.reshape(-1, planes)
+                    pixels[:, :colours] *= pixels[:, -1:]
+                total += samples
+            return total
+        # Each sample gets a lane of a long integer, wide enough for
+        # the sum, so a whole row is added with one addition.
+        length = self.width * planes
+        maxval = 2 ** (8 * self.bps) - 1
+        largest = count * maxval * (self.has_alpha and maxval or 1)
+        for size, code in ((1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q')):
+            if largest < 256 ** size:
                 break
-        scanlines = array('B', zlib.decompress(''.join(compressed)))
-        if interlaced:
-            pixels = self.deinterlace(scanlines)
-        else:
-            pixels = self.read_flat(scanlines)
-        image_metadata["greyscale"] = greyscale
-        image_metadata["has_alpha"] = has_alpha
-        image_metadata["bytes_per_sample"] = bps
-        image_metadata["interlaced"] = interlaced
-        return width, height, pixels, image_metadata
+        fmt = '>%d%s' % (length, code)
+        lanes = array('B', [0]) * (size * length)
+        total = 0
+        for y in range(count):
+            row = rows.next()
+            if self.has_alpha:
+                samples = list(_row_samples(row, self.bps))
+                alpha = samples[planes - 1::planes]
+                for i in range(colours):
+                    samples[i::planes] = map(mul, samples[i::planes], alpha)
+                total += long(hexlify(struct.pack(fmt, *samples)), 16)
+            else:
+                for i in range(self.bps):
+                    lanes[size - self.bps + i::size] = row[i::self.bps]
+                total += _row_to_long(lanes)
+        return struct.unpack(fmt, unhexlify('%0*x' % (2 * size * length,
+                                                      total)))
 
 
-def test_suite(options):
+_trial_scanlines = None
+
+
+def _set_trial_scanlines(scanlines):
     """
-    Run regression test and write PNG file to stdout.
+    Keep the scanlines for the trials of Writer.write_optimized(), in
+    this process or in each worker process.
+    """
+    global _trial_scanlines
+    _trial_scanlines = scanlines
+
+
+def _trial_round(task):
+    """
+    Filter the trial scanlines with one filter type and compress them
+    with each of the zlib settings, for Writer.write_optimized().
+    Return a list of (size, trial) pairs, the compressed data of the
+    smallest, and a Stats object with the filter types and the bytes
+    for zlib.
+    """
+    writer, filter_type, settings = task
+    previous = writer.filter_type, writer.stats
+    # Only the chosen round counts, so the writer's own Stats object
+    # is left out of the trials.
+    writer.filter_type, writer.stats = filter_type, None
+    counts = Stats()
+    try:
+        strips = list(writer.join_strips(counts.counted(
+            writer.filtered_lines(_trial_scanlines))))
+    finally:
+        writer.filter_type, writer.stats = previous
+    sizes = []
+    best = None
+    for level, strategy, mem_level, window_bits in settings:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, window_bits,
+                                      mem_level, strategy)
+        pieces = [compressor.compress(strip) for strip in strips]
+        pieces.append(compressor.flush())
+        size = sum(map(len, pieces))
+        sizes.append((size, (filter_type, level, strategy, mem_level,
+                             window_bits)))
+        if best is None or size < best[0]:
+            best = size, pieces
+    return sizes, best[1], counts
+
+
+# Ancillary chunks that must come before PLTE,
+# http://www.w3.org/TR/PNG/#5ChunkOrdering
+_before_palette = ('cHRM', 'gAMA', 'iCCP', 'sBIT', 'sRGB')
+
+
+def _resize_pieces(pieces, size):
+    """
+    Generator for the data of pieces joined and split again into
+    strings of size bytes, except for the last one.
+    """
+    # The pieces are only joined when there is enough for a string.
+    pending = []
+    pending_bytes = 0
+    for piece in pieces:
+        # Buffer objects cannot be joined.
+        pending.append(str(piece))
+        pending_bytes += len(piece)
+        if pending_bytes < size:
+            continue
+        data = ''.join(pending)
+        start = 0
+        while len(data) - start >= size:
+            yield data[start:start + size]
+            start += size
+        data = data[start:]
+        pending = [data]
+        pending_bytes = len(data)
+    yield ''.join(pending)
+
+
+def _recompressed(pieces, compressor, limit=2**16):
+    """
+    Generator for the compressed data of a zlib stream, decompressed
+    and compressed again with compressor.
+    """
+    decompressor = zlib.decompressobj()
+    for data in pieces:
+        while data:
+            yield compressor.compress(decompressor.decompress(data, limit))
+            data = decompressor.unconsumed_tail
+    yield compressor.compress(decompressor.flush())
+    yield compressor.flush()
+
+
+def rewrite(source, outfile, drop=(), insert=(), idat_size=None,
+            compression=None, strategy=None, mem_level=None,
+            window_bits=None, validate='strict'):
+    """
+    Copy a PNG file chunk by chunk to outfile, with changes.
+
+    Arguments:
+    source - PNG input file, or anything that Reader() accepts
+    outfile - file for the PNG output
+    drop - tags of ancillary chunks to leave out
+    insert - (tag, data) pairs of ancillary chunks to add
+    idat_size - split the image data into IDAT chunks of this size
+    compression, strategy, mem_level, window_bits - zlib settings
+    validate - checksum validation for Reader()
+
+    The image data is copied as it is, or only split into chunks of a
+    different size. If any zlib setting is given, it is decompressed
+    and compressed again, but the scanlines stay filtered, so this is
+    much faster than decoding and encoding the image. Inserted chunks
+    go after IHDR if they must come before PLTE, and right before the
+    image data otherwise.
+    """
+    for tag in list(drop) + [tag for tag, data in insert]:
+        if not tag[0].islower():
+            raise ValueError("only ancillary chunks can be dropped or"
+                             " inserted, not %s" % tag)
+    if hasattr(source, 'read'):
+        reader = Reader(file=source, validate=validate)
+    else:
+        reader = Reader(source, validate=validate)
+    chunks = reader.chunks()
+    tag, data = chunks.next()
+    if tag != 'IHDR':
+        raise Error("PNG file does not start with IHDR")
+    width, height = struct.unpack("!2I", data[:8])
+    recompress = [setting for setting in
+                  (compression, strategy, mem_level, window_bits)
+                  if setting is not None]
+    if recompress and not idat_size:
+        # The compressor returns many small pieces.
+        idat_size = 2**20
+    writer = Writer(width, height,
+                    compression=compression,
+                    strategy=strategy,
+                    mem_level=mem_level,
+                    window_bits=window_bits,
+                    idat_size=idat_size)
+
+    # http://www.w3.org/TR/PNG/#5PNG-file-signature
+    outfile.write(struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10))
+    writer.write_chunk(outfile, tag, data)
+    for tag, data in insert:
+        if tag in _before_palette:
+            writer.write_chunk(outfile, tag, data)
+    inserted = False
+    for is_idat, group in itertools.groupby(chunks,
+                                            lambda chunk: chunk[0] == 'IDAT'):
+        if not is_idat:
+            for tag, data in group:
+                if tag not in drop:
+                    writer.write_chunk(outfile, tag, data)
+            continue
+        if not inserted:
+            for tag, data in insert:
+                if tag not in _before_palette:
+                    writer.write_chunk(outfile, tag, data)
+            inserted = True
+        pieces = (data for tag, data in group)
+        if recompress:
+            pieces = _recompressed(pieces, writer.compressor())
+        writer.write_idat(outfile, pieces)
+
+
+def probe(source, validate='strict'):
+    """
+    Return width, height, image_metadata and the list of chunks of a
+    PNG file without decoding the image, see Reader.info(). The source
+    can be anything that Reader() accepts, usually a filename.
+    """
+    return Reader(source, validate=validate).info()
+
+
+class Decoder(Reader):
+    """
+    PNG decoder that is fed with the data in pieces instead of reading
+    a file, for programs that must not block, such as servers with an
+    event loop.
+    """
+
+    def __init__(self, validate='strict'):
+        """
+        Create a decoder, see Reader() for the validate argument.
+        """
+        Reader.__init__(self, file=None, validate=validate)
+        self.image_metadata = {}
+        self.signature = False
+        # The data is only joined when the next chunk is complete.
+        self.pending = []
+        self.pending_bytes = 0
+        self.needed = 8
+        self.decompressor = None
+        self.done = False
+
+    def feed(self, data):
+        """
+        Decode the next piece of PNG data, return a list with the rows
+        of pixels that it completes.
+
+        The rows are the same as from iter_rows(). The width, height
+        and image_metadata attributes are set when the first IDAT
+        chunk has arrived, and done is true after IEND. Only whole
+        chunks are decoded, and the image data is decompressed in
+        bounded steps. An interlaced image can only be put together
+        at the end, so all rows are returned by the piece with IEND.
+        """
+        if self.done:
+            raise Error("PNG data after IEND chunk")
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        rows = []
+        if self.pending_bytes < self.needed:
+            return rows
+        pending = ''.join(self.pending)
+        start = 0
+        if not self.signature:
+            if pending[:8] != struct.pack("8B", 137, 80, 78, 71,
+                                          13, 10, 26, 10):
+                raise Error("PNG file has invalid header")
+            self.signature = True
+            start = 8
+        # http://www.w3.org/TR/PNG/#5Chunk-layout
+        self.needed = 12
+        while len(pending) - start >= 12:
+            data_bytes, tag = struct.unpack('!I4s', pending[start:start + 8])
+            end = start + 12 + data_bytes
+            if len(pending) < end:
+                self.needed = end - start
+                break
+            data = pending[start + 8:end - 4]
+            try:
+                self.verify_chunk(tag, data, pending[end - 4:end])
+            except ValueError, e:
+                raise Error('Chunk error: ' + e.args[0])
+            start = end
+            if tag == 'IDAT':
+                rows.extend(self.feed_idat(data))
+            elif tag == 'IEND':
+                rows.extend(self.finish())
+                break
+            else:
+                self.process_chunk(tag, data)
+        pending = pending[start:]
+        self.pending = [pending]
+        self.pending_bytes = len(pending)
+        return rows
+
+    def feed_idat(self, data):
+        """
+        Decompress the data of an IDAT chunk, return the rows that are
+        complete.
+        """
+        if self.decompressor is None:
+            self.end_preamble()
+            self.decompressor = zlib.decompressobj()
+            self.scanlines = ''
+            self.passes = []
+            self.previous = None
+            self.y = 0
+        limit = max(self.row_bytes + 1, 2**16)
+        rows = []
+        while data:
+            rows.extend(self.feed_scanlines(
+                self.decompressor.decompress(data, limit)))
+            data = self.decompressor.unconsumed_tail
+        return rows
+
+    def feed_scanlines(self, data):
+        """
+        Add decompressed image data, return the rows that are complete.
+        """
+        if self.interlaced:
+            self.passes.append(data)
+            return []
+        self.scanlines += data
+        length = self.scanline_length(self.width)
+        rows = []
+        start = 0
+        while len(self.scanlines) - start > length and self.y < self.height:
+            filter_type = ord(self.scanlines[start])
+            line = array('B', self.scanlines[start + 1:start + 1 + length])
+            start += 1 + length
+            line = self.undo_filter(filter_type, line, self.previous)
+            self.previous = line
+            if self.bits_per_sample < 8:
+                row = _unpack_bits(line, self.bits_per_sample, self.width)
+            else:
+                row = line[:]
+            rows.append(self.expand_palette(row))
+            self.y += 1
+        self.scanlines = self.scanlines[start:]
+        return rows
+
+    def finish(self):
+        """
+        Finish the image at the IEND chunk, return the remaining rows.
+        """
+        if self.decompressor is None:
+            raise Error("PNG file has no image data")
+        self.done = True
+        rows = self.feed_scanlines(self.decompressor.flush())
+        if self.interlaced:
+            pixels = self.expand_palette(
+                self.deinterlace(array('B', ''.join(self.passes))))
+            self.passes = []
+            row_bytes = len(pixels) // self.height
+            rows = [pixels[y * row_bytes:(y + 1) * row_bytes]
+                    for y in range(self.height)]
+        elif self.y < self.height:
+            raise Error("image data is too short: %d of %d scanlines"
+                        % (self.y, self.height))
+        return rows
+
+
+def _read_file(filename):
+    """
+    Decode one PNG file in a worker process for read_many().
+    """
+    try:
+        width, height, pixels, image_metadata = Reader(filename).read()
+    except Exception, e:
+        return filename, None, e
+    # Arrays are pickled as lists of integers, strings are much faster.
+    return filename, (width, height, pixels.tostring(), image_metadata), None
+
+
+def read_many(filenames, workers=None, ordered=True, chunksize=1,
+              errors='raise'):
+    """
+    Decode many PNG files with a pool of worker processes.
+
+    Return a generator for (filename, result) pairs, where result is
+    the (width, height, pixels, image_metadata) tuple from
+    Reader.read(). The pairs come in the order of filenames, or as
+    soon as each file is done if ordered is False.
+
+    Arguments:
+    filenames - names of PNG input files
+    workers - number of processes (default: number of CPUs)
+    ordered - return the results in input order
+    chunksize - number of files sent to a worker at once
+    errors - what to do when a file cannot be decoded:
+             'raise' the exception, 'skip' the file, or 'collect' it
+             by returning the exception as its result
+
+    With one worker, the files are decoded in this process. Invalid
+    arguments raise ValueError at once, not when the generator runs.
+    """
+    if errors not in ('raise', 'skip', 'collect'):
+        raise ValueError("errors must be 'raise', 'skip' or 'collect'")
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    return _read_many(filenames, workers, ordered, chunksize, errors)
+
+
+def _read_many(filenames, workers, ordered, chunksize, errors):
+    """
+    Generator for the results of read_many(), with checked arguments.
+    """
+    pool = None
+    if workers == 1:
+        results = (_read_file(filename) for filename in filenames)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(_read_file, filenames, chunksize)
+        else:
+            results = pool.imap_unordered(_read_file, filenames, chunksize)
+    try:
+        for filename, result, error in results:
+            if error is None:
+                width, height, pixels, image_metadata = result
+                yield filename, (width, height, array('B', pixels),
+                                 image_metadata)
+            elif errors == 'raise':
+                raise error
+            elif errors == 'collect':
+                yield filename, error
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+# Synthetic test images.  Each pattern is computed a row at a time:
+# patterns that depend only on x repeat one row, patterns that depend
+# only on y repeat one value, and the others use numpy for whole rows
+# if it is available.  The "PHOTO" and "UI" patterns are random but
+# reproducible from a seed.
+
+def _samples(values, maxval, typecode):
+    """
+    Scale values from 0.0 to 1.0 (a list or a numpy array) to an array
+    of integer samples from 0 to maxval.
     """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        values = values * maxval
+        return array(typecode, values.astype(typecode == 'H' and
+                                             numpy.uint16 or
+                                             numpy.uint8).tostring())
+    return array(typecode, [int(value * maxval) for value in values])
 
-    # Below is a big stack of test image generators
 
-    def test_gradient_horizontal_lr(x, y):
-        return x
+def _stripe(x, n):
+    return int(x*n) & 1
 
-    def test_gradient_horizontal_rl(x, y):
-        return 1-x
 
-    def test_gradient_vertical_tb(x, y):
-        return y
+def _across_rows(function, width, height, depth, seed, plane):
+    """
+    Rows of a pattern that depends only on x.
+    """
+    row = _samples([function(float(x)/width) for x in range(width)],
+                   2**depth - 1, depth > 8 and 'H' or 'B')
+    for y in range(height):
+        yield row
+
+
+def _down_rows(function, width, height, depth, seed, plane):
+    """
+    Rows of a pattern that depends only on y.
+    """
+    maxval = 2**depth - 1
+    typecode = depth > 8 and 'H' or 'B'
+    for y in range(height):
+        yield _samples([function(float(y)/height)], maxval, typecode) * width
 
-    def test_gradient_vertical_bt(x, y):
-        return 1-y
 
-    def test_radial_tl(x, y):
-        return max(1-math.sqrt(x*x+y*y), 0.0)
+def _radial_rows(centre, width, height, depth, seed, plane):
+    """
+    Rows of a radial gradient, 1.0 at the centre and 0.0 at a distance
+    of 1.0 or more.  centre is a pair of functions that move x and y
+    to the coordinates relative to the centre.
+    """
+    maxval = 2**depth - 1
+    typecode = depth > 8 and 'H' or 'B'
+    across, down = centre
+    squares = [x*x for x in
+               [across(float(x)/width) for x in range(width)]]
+    if numpy is not None:
+        squares = numpy.array(squares)
+    for y in range(height):
+        y = down(float(y)/height)
+        if numpy is not None:
+            values = numpy.maximum(1-numpy.sqrt(squares+y*y), 0.0)
+        else:
+            values = [max(1-math.sqrt(square+y*y), 0.0)
+                      for square in squares]
+        yield _samples(values, maxval, typecode)
 
-    def test_radial_center(x, y):
-        return test_radial_tl(x-0.5, y-0.5)
 
-    def test_radial_tr(x, y):
-        return test_radial_tl(1-x, y)
+def _diagonal_rows(sign, width, height, depth, seed, plane):
+    """
+    Rows of 10 diagonal stripes, from top left to bottom right if sign
+    is 1, or from top right to bottom left if sign is -1.
+    """
+    maxval = 2**depth - 1
+    typecode = depth > 8 and 'H' or 'B'
+    xs = [float(x)/width for x in range(width)]
+    if numpy is not None:
+        xs = numpy.array(xs)
+    for y in range(height):
+        y = sign * (float(y)/height)
+        if numpy is not None:
+            values = ((xs+y)*10).astype(int) & 1
+        else:
+            values = [int((x+y)*10) & 1 for x in xs]
+        yield _samples(values, maxval, typecode)
 
-    def test_radial_bl(x, y):
-        return test_radial_tl(x, 1-y)
 
-    def test_radial_br(x, y):
-        return test_radial_tl(1-x, 1-y)
+def _checker_rows(n, width, height, depth, seed, plane):
+    """
+    Rows of a checkerboard with n by n squares.
+    """
+    maxval = 2**depth - 1
+    typecode = depth > 8 and 'H' or 'B'
+    bits = [_stripe(float(x)/width, n) for x in range(width)]
+    rows = (_samples(bits, maxval, typecode),
+            _samples([1 - bit for bit in bits], maxval, typecode))
+    for y in range(height):
+        yield rows[_stripe(float(y)/height, n)]
 
-    def test_stripe(x, n):
-        return 1.0*(int(x*n) & 1)
 
-    def test_stripe_h_2(x, y):
-        return test_stripe(x, 2)
+def _level_rows(rows, width, depth, rng=None):
+    """
+    Generator that scales rows of 8-bit levels to samples with depth
+    bits.  The low byte of 16-bit samples is random if rng is given,
+    otherwise it repeats the level, so that flat colours stay flat.
+    """
+    if depth < 8:
+        table = ''.join([chr(level >> 8 - depth) for level in range(256)])
+        for row in rows:
+            yield array('B', row.tostring().translate(table))
+    elif depth == 8:
+        for row in rows:
+            yield row
+    else:
+        pairs = array('B', [0]) * (2 * width)
+        for row in rows:
+            pairs[0::2] = row
+            if rng is None:
+                pairs[1::2] = row
+            else:
+                pairs[1::2] = _long_to_row(rng.getrandbits(8 * width), width)
+            yield _row_samples(pairs, 2)
 
-    def test_stripe_h_4(x, y):
-        return test_stripe(x, 4)
 
-    def test_stripe_h_10(x, y):
-        return test_stripe(x, 10)
+def _smooth_levels(rng, length, top):
+    """
+    Return a list of length levels from 0 to top that vary smoothly,
+    the sum of three waves with random frequency, phase and amplitude.
+    """
+    waves = [(rng.uniform(1.0, 6.0) * 2 * math.pi / length,
+              rng.uniform(0.0, 2 * math.pi), rng.random())
+             for i in range(3)]
+    values = [sum([amplitude * math.sin(frequency * i + phase)
+                   for frequency, phase, amplitude in waves])
+              for i in range(length)]
+    low = min(values)
+    scale = top / ((max(values) - low) or 1.0)
+    return [int((value - low) * scale) for value in values]
+
+
+def _photo_rows(argument, width, height, depth, seed, plane):
+    """
+    Rows like a photograph: smooth shading with fine grain.
+    """
+    rng = random.Random(seed << 2 | plane)
+    # Each level is the sum of up to 120 across, 120 down and 15 of
+    # grain, so the bytes of these long integers never carry into
+    # each other.
+    across = _row_to_long(array('B', _smooth_levels(rng, width, 120)))
+    down = _smooth_levels(rng, height, 120)
+    ones = _row_to_long(array('B', [1]) * width)
+    grain = ones * 15
 
-    def test_stripe_v_2(x, y):
-        return test_stripe(y, 2)
+    def rows():
+        for y in range(height):
+            yield _long_to_row(across + down[y] * ones +
+                               (rng.getrandbits(8 * width) & grain), width)
 
-    def test_stripe_v_4(x, y):
-        return test_stripe(y, 4)
+    return _level_rows(rows(), width, depth, rng)
 
-    def test_stripe_v_10(x, y):
-        return test_stripe(y, 10)
 
-    def test_stripe_lr_10(x, y):
-        return test_stripe(x+y, 10)
+def _glyphs(rng, count):
+    """
+    Return count random glyphs of 7 rows by 6 pixels, as strings of
+    '\\x00' (paper) and '\\x01' (ink).  The first glyph is a space.
+    """
+    glyphs = [['\x00' * 6] * 7]
+    for i in range(count - 1):
+        glyphs.append([''.join([chr(rng.getrandbits(1)) for x in range(5)])
+                       + '\x00' for y in range(7)])
+    return glyphs
 
-    def test_stripe_rl_10(x, y):
-        return test_stripe(x-y, 10)
 
-    def test_checker(x, y, n):
-        return 1.0*((int(x*n) & 1) ^ (int(y*n) & 1))
+def _ui_rows(argument, width, height, depth, seed, plane):
+    """
+    Rows like a screenshot of a user interface: overlapping flat
+    boxes with a border, some of them with lines of text.  The layout
+    depends only on the seed, so it is the same in every plane; the
+    colours depend on the plane as well.
+    """
+    layout = random.Random(seed)
+    colours = random.Random(seed << 2 | plane)
+    glyphs = _glyphs(layout, 16)
+    background = colours.randrange(160, 256)
+    boxes = []
+    for i in range(min(64, 4 + width * height // 16384)):
+        w = layout.randint(1, max(1, width // 2))
+        h = layout.randint(1, max(1, height // 3))
+        left = layout.randrange(width - w + 1)
+        top = layout.randrange(height - h + 1)
+        lines = []
+        if layout.random() < 0.5:
+            # Lines of text are 12 pixels apart, 2 pixels from the
+            # left and 3 pixels from the top of the box.
+            lines = [[layout.randrange(len(glyphs))
+                      for x in range((w - 4) // 6)]
+                     for y in range((h - 4) // 12)]
+        fill = colours.randrange(256)
+        edge = fill // 2
+        ink = colours.randrange(64)
+        table = chr(fill) + chr(ink) + '\x00' * 254
+        boxes.append((top, top + h, left, left + w,
+                      array('B', [fill]) * w, array('B', [edge]) * w,
+                      edge, lines, table))
+
+    def rows():
+        blank = array('B', [background]) * width
+        for y in range(height):
+            row = blank[:]
+            for (top, bottom, left, right, fill, border, edge, lines,
+                 table) in boxes:
+                if not top <= y < bottom:
+                    continue
+                if y == top or y == bottom - 1:
+                    row[left:right] = border
+                    continue
+                row[left:right] = fill
+                row[left] = row[right - 1] = edge
+                line, glyph_row = divmod(y - top - 3, 12)
+                if 0 <= line < len(lines) and glyph_row < 7:
+                    text = ''.join([glyphs[glyph][glyph_row]
+                                    for glyph in lines[line]])
+                    row[left + 2:left + 2 + len(text)] = array(
+                        'B', text.translate(table))
+            yield row
+
+    return _level_rows(rows(), width, depth)
+
+
+test_patterns = {
+    "GLR": (_across_rows, lambda x: x),
+    "GRL": (_across_rows, lambda x: 1-x),
+    "GTB": (_down_rows, lambda y: y),
+    "GBT": (_down_rows, lambda y: 1-y),
+    "RTL": (_radial_rows, (lambda x: x, lambda y: y)),
+    "RTR": (_radial_rows, (lambda x: 1-x, lambda y: y)),
+    "RBL": (_radial_rows, (lambda x: x, lambda y: 1-y)),
+    "RBR": (_radial_rows, (lambda x: 1-x, lambda y: 1-y)),
+    "RCTR": (_radial_rows, (lambda x: x-0.5, lambda y: y-0.5)),
+    "HS2": (_across_rows, lambda x: _stripe(x, 2)),
+    "HS4": (_across_rows, lambda x: _stripe(x, 4)),
+    "HS10": (_across_rows, lambda x: _stripe(x, 10)),
+    "VS2": (_down_rows, lambda y: _stripe(y, 2)),
+    "VS4": (_down_rows, lambda y: _stripe(y, 4)),
+    "VS10": (_down_rows, lambda y: _stripe(y, 10)),
+    "LRS": (_diagonal_rows, 1),
+    "RLS": (_diagonal_rows, -1),
+    "CK8": (_checker_rows, 8),
+    "CK15": (_checker_rows, 15),
+    "ZERO": (_down_rows, lambda y: 0),
+    "ONE": (_down_rows, lambda y: 1),
+    "PHOTO": (_photo_rows, None),
+    "UI": (_ui_rows, None),
+    }
+
+
+def pattern_rows(pattern, width, height, depth=8, seed=0, plane=0):
+    """
+    Generator for the rows of a single plane (monochrome) test
+    pattern.  Each row is an array of samples from 0 to 2**depth-1,
+    with native integers in an array('H') for 16-bit samples; the
+    same array may be returned for several rows.
+
+    pattern is one of the names in test_patterns.  The random
+    content of the "PHOTO" and "UI" patterns is the same for the same
+    seed and plane number.
+    """
+    function, argument = test_patterns[pattern]
+    return function(argument, width, height, depth, seed, plane)
 
-    def test_checker_8(x, y):
-        return test_checker(x, y, 8)
 
-    def test_checker_15(x, y):
-        return test_checker(x, y, 15)
+def pattern_image(width, height, patterns=("GTB", "GLR", "RTL"),
+                  depth=8, seed=0):
+    """
+    Generator for the rows of a test image with a pattern in each
+    plane, such as red, green, blue and alpha.  Each row is an array
+    of interleaved samples for Writer.write_rows(), see pattern_rows().
+    """
+    planes = [pattern_rows(pattern, width, height, depth, seed, plane)
+              for plane, pattern in enumerate(patterns)]
+    if len(planes) == 1:
+        for row in planes[0]:
+            yield row
+        return
+    for rows in itertools.izip(*planes):
+        row = rows[0] * len(rows)
+        for plane, samples in enumerate(rows):
+            row[plane::len(rows)] = samples
+        yield row
 
-    def test_zero(x, y):
-        return 0
 
-    def test_one(x, y):
-        return 1
+def write_corpus(directory, images, seed=0):
+    """
+    Write test images to PNG files in directory and return the list
+    of file names.  Each image is a (width, height, depth, patterns)
+    tuple for pattern_image(), with one or two patterns for
+    greyscale and three or four for RGB, the last one alpha if the
+    number is even.
+
+    The file names contain all the parameters, and files that exist
+    already are not written again, so the directory can be kept as a
+    cache of the corpus for benchmarks and tests.
+    """
+    filenames = []
+    for width, height, depth, patterns in images:
+        filename = os.path.join(directory, '%dx%d-%d-%s-%d.png' % (
+            width, height, depth, '-'.join(patterns), seed))
+        filenames.append(filename)
+        if os.path.exists(filename):
+            continue
+        writer = Writer(width, height,
+                        greyscale=len(patterns) < 3,
+                        has_alpha=len(patterns) % 2 == 0,
+                        bytes_per_sample=depth // 8 or 1,
+                        bits_per_sample=depth < 8 and depth or None)
+        # Write to another name first, so that an interrupted run
+        # does not leave a broken file in the cache.
+        partial = filename + '.partial'
+        outfile = open(partial, 'wb')
+        try:
+            writer.write(outfile, pattern_image(width, height, patterns,
+                                                depth, seed))
+        finally:
+            outfile.close()
+        os.rename(partial, filename)
+    return filenames
 
-    test_patterns = {
-        "GLR": test_gradient_horizontal_lr,
-        "GRL": test_gradient_horizontal_rl,
-        "GTB": test_gradient_vertical_tb,
-        "GBT": test_gradient_vertical_bt,
-        "RTL": test_radial_tl,
-        "RTR": test_radial_tr,
-        "RBL": test_radial_bl,
-        "RBR": test_radial_br,
-        "RCTR": test_radial_center,
-        "HS2": test_stripe_h_2,
-        "HS4": test_stripe_h_4,
-        "HS10": test_stripe_h_10,
-        "VS2": test_stripe_v_2,
-        "VS4": test_stripe_v_4,
-        "VS10": test_stripe_v_10,
-        "LRS": test_stripe_lr_10,
-        "RLS": test_stripe_rl_10,
-        "CK8": test_checker_8,
-        "CK15": test_checker_15,
-        "ZERO": test_zero,
-        "ONE": test_one,
-        }
 
-    def test_pattern(width, height, depth, pattern):
-        """
-        Create a single plane (monochrome) test pattern.
-        """
-        a = array('B')
-        fw = float(width)
-        fh = float(height)
-        pfun = test_patterns[pattern]
-        if depth == 1:
-            for y in range(height):
-                for x in range(width):
-                    a.append(int(pfun(float(x)/fw, float(y)/fh) * 255))
-        elif depth == 2:
-            for y in range(height):
-                for x in range(width):
-                    v = int(pfun(float(x)/fw, float(y)/fh) * 65535)
-                    a.append(v >> 8)
-                    a.append(v & 0xff)
-        return a
+def test_suite(options):
+    """
+    Run regression test and write PNG file to stdout.
+    """
 
     def test_rgba(size=256, depth=1,
                     red="GTB", green="GLR", blue="RTL", alpha=None):
         """
-        Create a test image.
+        Create the planes of a test image.
         """
-        r = test_pattern(size, size, depth, red)
-        g = test_pattern(size, size, depth, green)
-        b = test_pattern(size, size, depth, blue)
-        if alpha:
-            a = test_pattern(size, size, depth, alpha)
-        i = interleave_planes(r, g, depth, depth)
-        i = interleave_planes(i, b, 2 * depth, depth)
+        patterns = [red, green, blue]
         if alpha:
-            i = interleave_planes(i, a, 3 * depth, depth)
-        return i
+            patterns.append(alpha)
+        return [pattern_rows(pattern, size, size, 8 * depth,
+                             options.test_seed, plane)
+                for plane, pattern in enumerate(patterns)]
 
     # The body of test_suite()
     size = 256
@@ -925,7 +3737,7 @@ def test_suite(options):
         kwargs["blue"] = options.test_blue
     if options.test_alpha:
         kwargs["alpha"] = options.test_alpha
-    pixels = test_rgba(size, depth, **kwargs)
+    planes = test_rgba(size, depth, **kwargs)
 
     writer = Writer(size, size,
                     bytes_per_sample=depth,
@@ -934,8 +3746,10 @@ def test_suite(options):
                     gamma=options.gamma,
                     has_alpha=options.test_alpha,
                     compression=options.compression,
-                    interlaced=options.interlace)
-    writer.write_array(sys.stdout, pixels)
+                    interlaced=options.interlace,
+                    filter_type=options.filter,
+                    workers=options.workers)
+    writer.write_planes(sys.stdout, planes)
 
 
 def read_pnm_header(infile, supported='P6'):
@@ -1004,6 +3818,23 @@ def _main():
     parser.add_option("-c", "--compression",
                       action="store", type="int", metavar="level",
                       help="zlib compression level (0-9)")
+    parser.add_option("-f", "--filter",
+                      default="none", action="store", type="choice",
+                      choices=list(_filter_names) + ['adaptive'],
+                      metavar="type",
+                      help="scanline filter (none, sub, up, average,"
+                      " paeth or adaptive)")
+    parser.add_option("-w", "--workers",
+                      default=1, action="store", type="int", metavar="count",
+                      help="number of threads for compression")
+    parser.add_option("-p", "--palette",
+                      default=False, action="store_true",
+                      help="create a palette image if there are at most"
+                      " 256 colors")
+    parser.add_option("-s", "--shrink",
+                      default=False, action="store_true",
+                      help="use the smallest color type and bit depth"
+                      " that keeps all pixel values")
     parser.add_option("-T", "--test",
                       default=False, action="store_true",
                       help="create a test image")
@@ -1025,6 +3856,9 @@ def _main():
     parser.add_option("-S", "--test-size",
                       action="store", type="int", metavar="size",
                       help="width and height of the test image")
+    parser.add_option("--test-seed",
+                      default=0, action="store", type="int", metavar="seed",
+                      help="random seed for the PHOTO and UI test patterns")
     (options, args) = parser.parse_args()
 
     # Convert options
@@ -1056,7 +3890,11 @@ def _main():
                     background=options.background,
                     has_alpha=options.alpha is not None,
                     gamma=options.gamma,
-                    compression=options.compression)
+                    compression=options.compression,
+                    filter_type=options.filter,
+                    workers=options.workers,
+                    palette=options.palette and 'auto' or None,
+                    shrink=options.shrink)
     if options.alpha is not None:
         pgmfile = open(options.alpha, 'rb')
         awidth, aheight = read_pnm_header(pgmfile, 'P5')
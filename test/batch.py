@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Usage: batch.py [count] [size]
+
+Benchmark png.read_many() with an increasing number of worker
+processes, print files and megabytes per second for each.
+
+"""
+
+
+__revision__ = '$Rev$'
+
+
+import sys, os, time, shutil, tempfile, multiprocessing
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import png
+
+
+def make_files(directory, count, size):
+    """
+    Write count test images of size x size RGB pixels.
+    """
+    filenames = []
+    for i in range(count):
+        row = array('B', [(x * 3 + i) & 0xff for x in range(size * 3)])
+        filename = os.path.join(directory, 'batch-%04d.png' % i)
+        outfile = open(filename, 'wb')
+        png.Writer(size, size, filter_type='sub').write(
+            outfile, [row] * size)
+        outfile.close()
+        filenames.append(filename)
+    return filenames
+
+
+def benchmark_workers(filenames, workers):
+    """
+    Decode all files, return elapsed seconds and decoded bytes.
+    """
+    start = time.time()
+    total = 0
+    for filename, (width, height, pixels, metadata) in png.read_many(
+            filenames, workers=workers, chunksize=4):
+        total += len(pixels)
+    return time.time() - start, total
+
+
+def main(count=64, size=256):
+    """
+    Print a line of throughput results for each number of workers.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = make_files(directory, count, size)
+        for workers in range(1, multiprocessing.cpu_count() + 1):
+            seconds, total = benchmark_workers(filenames, workers)
+            print '%2d workers %7.1f files/s %7.2f MB/s' % (
+                workers, count / seconds, total / seconds / 2**20)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+"""
+Usage: bench.py [options]
+
+Benchmark png.Writer and png.Reader in this process for each colour
+type, bit depth, interlace mode, compression level and image size.
+Print throughput, latency percentiles and peak memory of each case,
+write the results as JSON, and compare them with a baseline file.
+
+The exit status is 1 if a case is slower, or needs more memory, than
+in the baseline by more than the threshold.
+
+"""
+
+
+__revision__ = '$Rev$'
+
+
+import sys, os, time, json, platform
+from array import array
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import png
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Colour type, bit depth and Writer arguments of each image format.
+# http://www.w3.org/TR/PNG/#table111
+FORMATS = [
+    (0, 1, {'greyscale': True, 'bits_per_sample': 1}),
+    (0, 2, {'greyscale': True, 'bits_per_sample': 2}),
+    (0, 4, {'greyscale': True, 'bits_per_sample': 4}),
+    (0, 8, {'greyscale': True}),
+    (0, 16, {'greyscale': True, 'bytes_per_sample': 2}),
+    (2, 8, {}),
+    (2, 16, {'bytes_per_sample': 2}),
+    (3, 1, {'bits_per_sample': 1}),
+    (3, 2, {'bits_per_sample': 2}),
+    (3, 4, {'bits_per_sample': 4}),
+    (3, 8, {}),
+    (4, 8, {'greyscale': True, 'has_alpha': True}),
+    (4, 16, {'greyscale': True, 'has_alpha': True, 'bytes_per_sample': 2}),
+    (6, 8, {'has_alpha': True}),
+    (6, 16, {'has_alpha': True, 'bytes_per_sample': 2}),
+    ]
+
+PLANES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def make_pixels(width, height, planes, depth):
+    """
+    Return a flat array of pixels like a photograph, with smooth
+    shading and fine grain, so that the compression levels make a
+    difference.
+    """
+    pixels = array(depth == 16 and 'H' or 'B')
+    for row in png.pattern_image(width, height, ('PHOTO',) * planes, depth):
+        pixels.extend(row)
+    return pixels
+
+
+def make_writer(width, height, colour_type, depth, options, interlaced,
+                level):
+    """
+    Return a png.Writer for one case.
+    """
+    options = dict(options)
+    if colour_type == 3:
+        options['palette'] = [(i, 255 - i, i // 2, 255 - i // 4)
+                              for i in range(2 ** depth)]
+    return png.Writer(width, height, interlaced=interlaced,
+                      compression=level, **options)
+
+
+def percentile(values, fraction):
+    """
+    Return the value at fraction of the sorted values (nearest rank).
+    """
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def _status_bytes(field):
+    """
+    Return a memory size in bytes from /proc/self/status.
+    """
+    for line in open('/proc/self/status'):
+        if line.startswith(field + ':'):
+            return int(line.split()[1]) * 1024
+    raise IOError('no %s in /proc/self/status' % field)
+
+
+def peak_memory(function):
+    """
+    Return the peak number of bytes that function() allocates, or
+    None if it cannot be measured here.
+
+    With tracemalloc the peak of the traced allocations is returned.
+    Otherwise function() runs in a child process from fork(), which
+    resets its high water mark of resident memory first, and reports
+    how far the mark rose above the resident memory at the start.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    if not hasattr(os, 'fork') or not os.path.exists('/proc/self/status'):
+        return None
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        result = 'None'
+        try:
+            os.close(read_end)
+            # http://www.kernel.org/doc/Documentation/filesystems/proc.txt
+            clear_refs = open('/proc/self/clear_refs', 'w')
+            clear_refs.write('5')
+            clear_refs.close()
+            start = _status_bytes('VmRSS')
+            function()
+            result = str(_status_bytes('VmHWM') - start)
+        finally:
+            os.write(write_end, result)
+            os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 100)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    if result in ('', 'None'):
+        return None
+    return int(result)
+
+
+def measure(function, repeat):
+    """
+    Run function() repeat times, return the list of seconds per run.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return times
+
+
+def run_case(name, function, raw_bytes, repeat, memory):
+    """
+    Benchmark one case, return a dictionary with the results.
+    """
+    function()
+    times = measure(function, repeat)
+    result = {
+        'name': name,
+        'runs': repeat,
+        'mb_per_s': raw_bytes / min(times) / 2**20,
+        'latency_ms': dict((key, percentile(times, fraction) * 1000)
+                           for key, fraction in (('min', 0.0),
+                                                 ('p50', 0.5),
+                                                 ('p90', 0.9),
+                                                 ('p99', 0.99),
+                                                 ('max', 1.0))),
+        'peak_memory': memory and peak_memory(function) or None,
+        }
+    return result
+
+
+def iter_cases(sizes, levels, formats):
+    """
+    Generator for the parameters of each case.
+    """
+    for size in sizes:
+        for colour_type, depth, options in FORMATS:
+            if formats and '%d/%d' % (colour_type, depth) not in formats:
+                continue
+            for interlaced in (False, True):
+                for level in levels:
+                    yield size, colour_type, depth, options, interlaced, level
+
+
+def run_suite(sizes, levels, formats=(), repeat=5, memory=True,
+              report=None):
+    """
+    Run the benchmark cases, return a list of result dictionaries.
+    Each result is passed to report() as soon as it is complete.
+    """
+    results = []
+    images = {}
+    for (size, colour_type, depth, options, interlaced,
+         level) in iter_cases(sizes, levels, formats):
+        planes = PLANES[colour_type]
+        key = size, planes, depth
+        if key not in images:
+            images[key] = make_pixels(size, size, planes, depth)
+        pixels = images[key]
+        raw_bytes = size * size * planes * max(depth, 8) // 8
+        writer = make_writer(size, size, colour_type, depth, options,
+                             interlaced, level)
+        outfile = StringIO()
+        writer.write_array(outfile, pixels)
+        data = outfile.getvalue()
+        label = '%dx%d ct%d %dbit %s level%s' % (
+            size, size, colour_type, depth,
+            interlaced and 'interlaced' or 'progressive', level)
+
+        def encode():
+            make_writer(size, size, colour_type, depth, options,
+                        interlaced, level).write_array(StringIO(), pixels)
+
+        def decode():
+            png.Reader(pixels=data).read()
+
+        for operation, function in (('encode', encode),
+                                    ('decode', decode)):
+            result = run_case(operation + ' ' + label, function, raw_bytes,
+                              repeat, memory)
+            result.update({'operation': operation, 'size': size,
+                           'colour_type': colour_type, 'bit_depth': depth,
+                           'interlaced': interlaced, 'compression': level,
+                           'raw_bytes': raw_bytes, 'png_bytes': len(data)})
+            results.append(result)
+            if report is not None:
+                report(result)
+    return results
+
+
+def print_result(result):
+    """
+    Print one line for a result.
+    """
+    latency = result['latency_ms']
+    memory = result['peak_memory']
+    if memory is None:
+        memory = '-'
+    else:
+        memory = '%.1f' % (memory / 2.0**20)
+    print '%-50s %8.2f MB/s p50 %8.2f p90 %8.2f p99 %8.2f ms %7s MB' % (
+        result['name'], result['mb_per_s'], latency['p50'], latency['p90'],
+        latency['p99'], memory)
+    sys.stdout.flush()
+
+
+def compare(results, baseline, threshold):
+    """
+    Return a list of messages for the results that are worse than in
+    the baseline by more than threshold (a fraction).
+    """
+    previous = dict((result['name'], result)
+                    for result in baseline['results'])
+    regressions = []
+    for result in results:
+        if result['name'] not in previous:
+            continue
+        old = previous[result['name']]
+        if result['mb_per_s'] < old['mb_per_s'] * (1 - threshold):
+            regressions.append('%s: %.2f MB/s instead of %.2f MB/s' % (
+                result['name'], result['mb_per_s'], old['mb_per_s']))
+        # Small differences in memory are noise from the allocator.
+        if result['peak_memory'] and old['peak_memory'] and \
+           result['peak_memory'] > old['peak_memory'] * (1 + threshold) + \
+           2**20:
+            regressions.append('%s: %.1f MB peak memory instead of %.1f MB'
+                               % (result['name'],
+                                  result['peak_memory'] / 2.0**20,
+                                  old['peak_memory'] / 2.0**20))
+    return regressions
+
+
+def main():
+    """
+    Run the benchmark suite with the command line options.
+    """
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--sizes', default='64,512',
+                      help="comma separated image sizes (default 64,512)")
+    parser.add_option('--levels', default='1,6,9',
+                      help="comma separated compression levels"
+                      " (default 1,6,9)")
+    parser.add_option('--formats', default='',
+                      help="comma separated colour type/bit depth pairs"
+                      " such as 2/8,0/16 (default all)")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="runs of each case (default 5)")
+    parser.add_option('--no-memory', action='store_false', dest='memory',
+                      default=True, help="do not measure peak memory")
+    parser.add_option('--json', metavar='FILE',
+                      help="write the results to a JSON file")
+    parser.add_option('--baseline', metavar='FILE',
+                      help="compare with the results in a JSON file")
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help="allowed regression as a fraction (default 0.1)")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("no arguments expected")
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    levels = [int(level) for level in options.levels.split(',')]
+    formats = [pair for pair in options.formats.split(',') if pair]
+    results = run_suite(sizes, levels, formats, options.repeat,
+                        options.memory, print_result)
+    if options.json:
+        outfile = open(options.json, 'w')
+        json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'results': results}, outfile, indent=1, sort_keys=True)
+        outfile.close()
+    if options.baseline:
+        regressions = compare(results, json.load(open(options.baseline)),
+                              options.threshold)
+        for message in regressions:
+            print >> sys.stderr, 'regression:', message
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
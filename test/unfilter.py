@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Usage: unfilter.py [seed]
+
+Check that every unfilter backend of png.Reader gives the same
+scanlines as the original byte-by-byte reconstruction, for every
+filter type, bit depth and Adam7 pass, and that images written with
+each filter decode to the same pixels with every backend. Print the
+number of checks and exit with status 1 on the first mismatch.
+
+"""
+
+
+__revision__ = '$Rev$'
+
+
+import sys, os, random
+from array import array
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import png
+
+
+# Planes and Writer arguments for each colour type, and the bit depths
+# it allows. http://www.w3.org/TR/PNG/#table111
+COLOUR_TYPES = [
+    (0, 1, {'greyscale': True}, (1, 2, 4, 8, 16)),
+    (2, 3, {}, (8, 16)),
+    (4, 2, {'greyscale': True, 'has_alpha': True}, (8, 16)),
+    (6, 4, {'has_alpha': True}, (8, 16)),
+    ]
+
+WIDTHS = (1, 2, 3, 5, 7, 8, 9, 13, 17)
+
+
+def reference_unfilter(filter_type, line, prev, psize):
+    """
+    Reverse a scanline filter one byte at a time, the way the
+    _reconstruct_* methods of the original Reader did. The prev
+    argument is None for the first scanline of a pass.
+    """
+    # http://www.w3.org/TR/PNG/#9Filter-types
+    out = array('B', line)
+    for i in range(len(out)):
+        x = out[i]
+        if i >= psize:
+            a = out[i - psize]
+        else:
+            a = 0
+        if prev is None:
+            b = c = 0
+        else:
+            b = prev[i]
+            if i >= psize:
+                c = prev[i - psize]
+            else:
+                c = 0
+        if filter_type == 1:
+            out[i] = (x + a) & 0xff
+        elif filter_type == 2:
+            out[i] = (x + b) & 0xff
+        elif filter_type == 3:
+            out[i] = (x + ((a + b) >> 1)) & 0xff
+        elif filter_type == 4:
+            p = a + b - c
+            pa = abs(p - a)
+            pb = abs(p - b)
+            pc = abs(p - c)
+            if pa <= pb and pa <= pc:
+                out[i] = (x + a) & 0xff
+            elif pb <= pc:
+                out[i] = (x + b) & 0xff
+            else:
+                out[i] = (x + c) & 0xff
+    return out
+
+
+def backends():
+    """
+    Return (name, function) pairs for every unfilter implementation,
+    with the same arguments as the _unfilter_* functions.
+    """
+    result = sorted(png._unfilter_backends.items())
+    if png.numpy is not None:
+        def ndarray(filter_type, line, prev, psize):
+            out = png.numpy.zeros(len(line), png.numpy.uint8)
+            if prev is not None:
+                prev = png.numpy.frombuffer(prev, png.numpy.uint8)
+            png._unfilter_ndarray(filter_type, line, prev, psize, out)
+            return array('B', out.tostring())
+        result.append(('ndarray', ndarray))
+    return result
+
+
+def pass_widths(width):
+    """
+    Return the number of pixels in a row of each Adam7 pass, and of a
+    non-interlaced row, leaving out empty passes.
+    """
+    widths = [width]
+    for xstart, ystart, xstep, ystep in png._adam7:
+        if xstart < width:
+            widths.append((width - xstart + xstep - 1) // xstep)
+    return widths
+
+
+def check_scanlines(rng):
+    """
+    Compare each backend with reference_unfilter() on random
+    scanlines. Return the number of comparisons.
+    """
+    count = 0
+    for colour_type, planes, options, depths in COLOUR_TYPES:
+        for depth in depths:
+            psize = max(1, planes * depth // 8)
+            for width in WIDTHS:
+                for pixels in pass_widths(width):
+                    length = (pixels * planes * depth + 7) // 8
+                    line = array('B', [rng.randrange(256)
+                                       for i in range(length)])
+                    previous = array('B', [rng.randrange(256)
+                                           for i in range(length)])
+                    for filter_type in range(5):
+                        for prev in (None, previous):
+                            expected = reference_unfilter(filter_type,
+                                                          line, prev, psize)
+                            for name, function in backends():
+                                got = function(filter_type, array('B', line),
+                                               prev, psize)
+                                if list(got) != list(expected):
+                                    raise AssertionError(
+                                        '%s backend, filter %d, colour type'
+                                        ' %d, %d bit, %d bytes, first line'
+                                        ' %s' % (name, filter_type,
+                                                 colour_type, depth, length,
+                                                 prev is None))
+                                count += 1
+    return count
+
+
+def check_images(rng):
+    """
+    Write random images with each filter, interlaced and not, read
+    them back with each backend and compare the pixels. Return the
+    number of comparisons.
+    """
+    count = 0
+    saved = png.unfilter_backend
+    try:
+        for colour_type, planes, options, depths in COLOUR_TYPES:
+            for depth in depths:
+                for width, height in ((1, 1), (7, 5), (13, 17)):
+                    maxval = 2 ** depth - 1
+                    pixels = array(depth == 16 and 'H' or 'B',
+                                   [rng.randint(0, maxval) for i in
+                                    range(width * height * planes)])
+                    for interlaced in (False, True):
+                        for filter_type in (0, 1, 2, 3, 4, 'adaptive'):
+                            writer = png.Writer(
+                                width, height, interlaced=interlaced,
+                                filter_type=filter_type,
+                                bytes_per_sample=depth // 8 or 1,
+                                bits_per_sample=depth < 8 and depth or None,
+                                **options)
+                            outfile = StringIO()
+                            writer.write_array(outfile, pixels)
+                            for name in sorted(png._unfilter_backends):
+                                png.unfilter_backend = name
+                                result = png.Reader(
+                                    pixels=outfile.getvalue()).read(
+                                    samples=True)[2]
+                                if list(result) != list(pixels):
+                                    raise AssertionError(
+                                        '%s backend, filter %s, colour type'
+                                        ' %d, %d bit, %dx%d, interlaced %s'
+                                        % (name, filter_type, colour_type,
+                                           depth, width, height, interlaced))
+                                count += 1
+    finally:
+        png.unfilter_backend = saved
+    return count
+
+
+def main(seed=0):
+    """
+    Run the checks and print the number of comparisons.
+    """
+    rng = random.Random(seed)
+    try:
+        scanlines = check_scanlines(rng)
+        images = check_images(rng)
+    except AssertionError, error:
+        print >> sys.stderr, 'mismatch:', error
+        sys.exit(1)
+    print '%d scanlines and %d images match with backends %s' % (
+        scanlines, images, ', '.join([name for name, function in backends()]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
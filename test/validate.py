@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Usage: validate.py [filename] [repeat]
+
+Benchmark png.Reader with each level of checksum validation, print
+megabytes per second for reading the chunks alone and for decoding
+the whole image.
+
+"""
+
+
+__revision__ = '$Rev$'
+
+
+import sys, os, time
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import png
+
+
+LEVELS = ('strict', 'critical', 'none')
+
+
+def read_chunks(data, validate):
+    """
+    Read all chunks of a PNG file without decompressing them.
+    """
+    reader = png.Reader(file=StringIO(data), validate=validate)
+    reader.file.read(8)
+    while reader.read_chunk()[0] != 'IEND':
+        pass
+
+
+def decode(data, validate):
+    """
+    Decode a PNG file, return the number of pixel bytes.
+    """
+    reader = png.Reader(file=StringIO(data), validate=validate)
+    width, height, pixels, metadata = reader.read()
+    return len(pixels)
+
+
+def best_time(function, data, validate, repeat):
+    """
+    Return the fastest of repeat runs in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function(data, validate)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(filename=None, repeat=3):
+    """
+    Print a line of throughput results for each validation level.
+    """
+    if filename is None:
+        filename = os.path.join(os.path.dirname(__file__), 'large.png')
+    data = open(filename, 'rb').read()
+    pixel_bytes = decode(data, 'strict')
+    for validate in LEVELS:
+        chunks = best_time(read_chunks, data, validate, repeat * 10)
+        pixels = best_time(decode, data, validate, repeat)
+        print '%-8s chunks %8.1f MB/s  decode %6.2f MB/s' % (
+            validate, len(data) / chunks / 2**20,
+            pixel_bytes / pixels / 2**20)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2] + [int(arg) for arg in sys.argv[2:]])